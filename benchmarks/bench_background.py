@@ -0,0 +1,65 @@
+""" Parity benchmark of the fast background engines against the reference ones
+
+Renders the same number of backgrounds with each engine and compares their
+speed and image statistics: mean intensity, contrast (standard deviation)
+and texture (mean gradient magnitude).
+
+    python benchmarks/bench_background.py --size 960 1280 --samples 50
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import generate_shape_2d as shapes  # noqa: E402
+
+ENGINES = [
+    ('background', shapes.generate_background, shapes.generate_background_fast),
+    ('custom_background',
+     lambda size: shapes.generate_custom_background(size, 128),
+     lambda size: shapes.generate_custom_background_fast(size, 128)),
+]
+
+
+def image_statistics(img):
+    gx = cv2.Sobel(img, cv2.CV_32F, 1, 0)
+    gy = cv2.Sobel(img, cv2.CV_32F, 0, 1)
+    return np.array([img.mean(), img.std(), np.mean(np.sqrt(gx ** 2 + gy ** 2))])
+
+
+def run(engine, size, samples, seed):
+    shapes.set_random_state(np.random.RandomState(seed))
+    stats = []
+    elapsed = 0.
+    for _ in range(samples):
+        start = time.perf_counter()
+        img = engine(size)
+        elapsed += time.perf_counter() - start
+        stats.append(image_statistics(img))
+    return elapsed / samples, np.mean(stats, axis=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, nargs=2, default=(960, 1280), metavar=('H', 'W'))
+    parser.add_argument('--samples', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    size = tuple(args.size)
+    print('%-18s %-9s %10s %8s %8s %9s' % ('engine', 'version', 'ms/image', 'mean', 'std', 'gradient'))
+    for name, reference, fast in ENGINES:
+        timings = {}
+        for version, engine in (('reference', reference), ('fast', fast)):
+            timings[version], (mean, std, gradient) = run(engine, size, args.samples, args.seed)
+            print('%-18s %-9s %10.2f %8.1f %8.1f %9.2f'
+                  % (name, version, 1000 * timings[version], mean, std, gradient))
+        print('%-18s speedup x%.1f' % (name, timings['reference'] / timings['fast']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+""" Reproducible benchmark of the synthetic shape generators
+
+For every combination of generator, image size, shape count and worker
+count, renders a fixed number of seeded samples and measures:
+  samples_per_s: throughput, through generate_dataset for the worker counts
+  failure_rate: fraction of samples the generator gave up on
+  peak_mb: peak memory allocated while rendering (in process, tracemalloc)
+  max_rss_mb: peak resident size of the process, or of the largest worker,
+              every configuration being measured in a fresh process
+  counters: rejection-loop and failure counters per sample (shape_profiling)
+  sampling: acceptance rates of the rejection samplers
+'background' and 'bezier' benchmark generate_background() and bezier_batch(),
+in process only.
+
+Results are saved as JSON to compare across commits:
+
+    python benchmarks/bench_generators.py --sizes 480x640 960x1280 --workers 1 8
+    python benchmarks/bench_generators.py --compare results/a.json results/b.json
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import generate_dataset  # noqa: E402
+import generate_shape_2d as shapes  # noqa: E402
+import shape_profiling  # noqa: E402
+
+IN_PROCESS_KINDS = ['background', 'bezier']
+KINDS = list(generate_dataset.GENERATORS) + IN_PROCESS_KINDS
+# parameter each shape count is passed as
+COUNT_PARAMETERS = {
+    'lines': 'nb_lines',
+    'polygon': 'max_sides',
+    'contours': 'max_n',
+    'multiple_polygons': 'nb_polygons',
+    'ellipses': 'nb_ellipses',
+    'background': 'nb_blobs',
+    'bezier': 'num_segments',
+}
+
+
+def parse_size(text):
+    h, w = text.lower().split('x')
+    return int(h), int(w)
+
+
+def render_background(index, seed, size, count):
+    shapes.set_random_state(generate_dataset.sample_random_state(seed, index))
+    return shapes.generate_background(size, nb_blobs=count)
+
+
+def render_bezier(index, seed, size, count):
+    state = generate_dataset.sample_random_state(seed, index)
+    return shapes.bezier_batch(state.rand(count, 4, 2) * size[::-1])
+
+
+def run_in_process(kind, size, count, samples, seed):
+    """ Render the samples in the calling process and return the number of successes """
+    if kind == 'background':
+        for i in range(samples):
+            render_background(i, seed, size, count)
+        return samples
+    if kind == 'bezier':
+        for i in range(samples):
+            render_bezier(i, seed, size, count)
+        return samples
+    return sum(1 for _ in generate_dataset.generate_dataset(
+        kind, samples, seed, num_workers=1, size=size, **{COUNT_PARAMETERS[kind]: count}))
+
+
+def measure(kind, size, count, workers, samples, seed):
+    result = {'kind': kind, 'size': list(size), 'count': count, 'workers': workers,
+              'samples': samples, 'seed': seed}
+    start = time.perf_counter()
+    if workers == 1:
+        successes = run_in_process(kind, size, count, samples, seed)
+    else:
+        successes = sum(1 for _ in generate_dataset.generate_dataset(
+            kind, samples, seed, num_workers=workers, size=size,
+            **{COUNT_PARAMETERS[kind]: count}))
+    elapsed = time.perf_counter() - start
+    result['samples_per_s'] = successes / elapsed
+    result['failure_rate'] = 1 - successes / samples
+    usage = resource.getrusage(resource.RUSAGE_SELF if workers == 1 else resource.RUSAGE_CHILDREN)
+    result['max_rss_mb'] = usage.ru_maxrss / 2 ** 10  # kilobytes on Linux
+    if workers != 1:
+        return result
+
+    # Second in-process pass for memory and rejection statistics, which
+    # slow the generation down and cannot be collected from the workers
+    shape_profiling.profiler.reset()
+    shape_profiling.sampling_stats.reset()
+    shape_profiling.enable_profiling()
+    tracemalloc.start()
+    try:
+        run_in_process(kind, size, count, samples, seed)
+        result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+        shape_profiling.enable_profiling(False)
+    summary = shape_profiling.profiler.summary()
+    result['counters'] = {name: n / samples for name, n in summary['counts'].items()}
+    result['sampling'] = {name: stats['acceptance_rate']
+                          for name, stats in summary['sampling'].items()}
+    return result
+
+
+def measure_in_subprocess(*args):
+    """ Run measure() in a fresh interpreter: ru_maxrss is the peak since the
+    start of the process, so it would otherwise carry over from the previous
+    configurations """
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+        return executor.submit(measure, *args).result()
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = 'unknown'
+    return {'commit': commit, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'opencv': cv2.__version__, 'cpu_count': multiprocessing.cpu_count(),
+            'machine': platform.machine()}
+
+
+def result_key(result):
+    return (result['kind'], tuple(result['size']), result['count'], result['workers'])
+
+
+HEADER = '%-18s %-10s %6s %7s %12s %8s %9s' % ('kind', 'size', 'count', 'workers',
+                                               'samples/s', 'failed', 'peak MB')
+
+
+def format_result(r):
+    peak = '%9.1f' % r['peak_mb'] if 'peak_mb' in r else '%9s' % '-'
+    return ('%-18s %-10s %6d %7d %12.1f %8.3f %s'
+            % (r['kind'], '%dx%d' % tuple(r['size']), r['count'], r['workers'],
+               r['samples_per_s'], r['failure_rate'], peak))
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    old_results = {result_key(r): r for r in old['results']}
+    print('%s (%s) -> %s (%s)' % (old_path, old['environment']['commit'],
+                                   new_path, new['environment']['commit']))
+    print('%-18s %-10s %6s %7s %12s %12s %8s' % ('kind', 'size', 'count', 'workers',
+                                                 'old/s', 'new/s', 'speedup'))
+    for r in new['results']:
+        o = old_results.get(result_key(r))
+        if o is None:
+            continue
+        print('%-18s %-10s %6d %7d %12.1f %12.1f %7.2fx'
+              % (r['kind'], '%dx%d' % tuple(r['size']), r['count'], r['workers'],
+                 o['samples_per_s'], r['samples_per_s'],
+                 r['samples_per_s'] / max(o['samples_per_s'], 1e-9)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--kinds', nargs='+', default=KINDS, choices=KINDS)
+    parser.add_argument('--sizes', nargs='+', type=parse_size, default=[(480, 640), (960, 1280)],
+                        metavar='HxW')
+    parser.add_argument('--counts', nargs='+', type=int, default=None,
+                        help='shape counts, the generator defaults by default')
+    parser.add_argument('--workers', nargs='+', type=int, default=[1])
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=os.path.join(ROOT, 'benchmarks', 'results'),
+                        help='directory the JSON results are saved to')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two saved results instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    default_counts = {'lines': 10, 'polygon': 15, 'contours': 20, 'multiple_polygons': 30,
+                      'ellipses': 40, 'background': 100, 'bezier': 20}
+    results = []
+    print(HEADER)
+    for kind in args.kinds:
+        for size in args.sizes:
+            for count in args.counts or [default_counts[kind]]:
+                # nothing to parallelize for the in-process kinds
+                for workers in [1] if kind in IN_PROCESS_KINDS else args.workers:
+                    results.append(measure_in_subprocess(kind, size, count, workers, args.samples,
+                                                         args.seed))
+                    print(format_result(results[-1]))
+
+    os.makedirs(args.output, exist_ok=True)
+    env = environment()
+    path = os.path.join(args.output, '%s-%s.json' % (env['date'].replace(':', ''), env['commit']))
+    with open(path, 'w') as f:
+        json.dump({'environment': env, 'results': results}, f, indent=1)
+    print('saved %s' % path)
+
+
+if __name__ == '__main__':
+    main()
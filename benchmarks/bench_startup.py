@@ -0,0 +1,74 @@
+""" Startup cost of the generator modules and of the worker pools
+
+Measures, in fresh interpreters, the time to import each library module and
+the time for a process pool of each start method to render one sample per worker.
+Both are paid by every worker of generate_dataset().
+
+    python benchmarks/bench_startup.py --repeats 5 --workers 4
+"""
+import argparse
+import multiprocessing
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ['numpy', 'cv2', 'generate_shape_2d', 'generate_dataset', 'shape_shards']
+HEAVY_MODULES = ['matplotlib', 'scipy']
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import %s
+print(time.perf_counter() - start)
+print(' '.join(m for m in %r if m in sys.modules))
+"""
+
+POOL_SCRIPT = """
+import multiprocessing, time
+from functools import partial
+start = time.perf_counter()
+import generate_dataset
+with multiprocessing.get_context(%r).Pool(%d) as pool:
+    list(pool.imap(partial(generate_dataset.generate_sample, 'polygon'), range(%d)))
+    first = time.perf_counter() - start
+print(first)
+"""
+
+
+def run_script(script):
+    return subprocess.check_output([sys.executable, '-c', script], cwd=ROOT).decode().split('\n')
+
+
+def measure_import(module, repeats):
+    """ Return the fastest import time of 'module' and the heavy modules it loaded """
+    timings = []
+    for _ in range(repeats):
+        elapsed, heavy = run_script(IMPORT_SCRIPT % (module, HEAVY_MODULES))[:2]
+        timings.append(float(elapsed))
+    return min(timings), heavy.split()
+
+
+def measure_pool(method, workers, repeats):
+    return min(float(run_script(POOL_SCRIPT % (method, workers, workers))[0])
+               for _ in range(repeats))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    print('%-20s %10s   %s' % ('module', 'import ms', 'heavy dependencies loaded'))
+    for module in MODULES:
+        elapsed, heavy = measure_import(module, args.repeats)
+        print('%-20s %10.1f   %s' % (module, 1000 * elapsed, ' '.join(heavy) or '-'))
+    print()
+    print('%-20s %10s' % ('pool start method', 'ready ms'))
+    for method in multiprocessing.get_all_start_methods():
+        print('%-20s %10.1f' % (method, 1000 * measure_pool(method, args.workers, args.repeats)))
+
+
+if __name__ == '__main__':
+    main()
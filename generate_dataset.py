@@ -0,0 +1,395 @@
+""" Parallel generation of synthetic shape datasets
+
+Every sample is rendered with its own RandomState seeded from
+(base_seed, sample_index), so a dataset only depends on its seed and
+never on the number of workers used to generate it. """
+import json
+import multiprocessing
+import signal
+from functools import partial
+
+import numpy as np
+
+import generate_shape_2d as shapes
+from shape_shards import ShardWriter
+
+GENERATORS = {
+    'lines': shapes.draw_lines,
+    'polygon': shapes.draw_polygon,
+    'contours': shapes.draw_contours,
+    'multiple_polygons': shapes.draw_multiple_polygons,
+    'ellipses': shapes.draw_ellipses,
+}
+
+
+def sample_random_state(base_seed, index):
+    """ Return the RandomState used to render the sample 'index' """
+    return np.random.RandomState([base_seed, index])
+
+
+def start_sample(kind, index, base_seed=0, size=(480, 640), background=True, img=None):
+    """ First half of generate_sample(): draw the background of a sample.
+    Returns the sample dict and the RandomState to finish it with, see finish_sample()
+    Parameters:
+      img: preallocated frame to draw the background into
+      see generate_sample() for the others
+    """
+    state = sample_random_state(base_seed, index)
+    shapes.set_random_state(state)
+    if callable(background):
+        img = background(size, out=img)
+    elif background:
+        img = shapes.generate_background(size, out=img)
+    elif img is None:
+        img = np.zeros(size, np.uint8)
+    else:
+        img[...] = 0
+    sample = {'index': index, 'kind': kind, 'image': img, 'template': None,
+              'M': None, 'points': None, 'template_points': None, 'ground_truth': None,
+              'pyramid': None}
+    return sample, state
+
+
+def finish_sample(sample, state, template_buffer=None, ground_truth=False, pyramid_levels=1,
+                  **kwargs):
+    """ Second half of generate_sample(): draw the shapes of a sample started
+    by start_sample(), possibly in another thread, and return it, or None if
+    the generator failed
+    Parameters:
+      state: RandomState returned by start_sample()
+      template_buffer: preallocated frame to draw the template into
+      see generate_sample() for the others
+    """
+    shapes.set_random_state(state)
+    kind, img = sample['kind'], sample['image']
+    if ground_truth or pyramid_levels > 1:
+        truth = GENERATORS[kind](img, ground_truth=True, **kwargs)
+        if truth is None:
+            return None
+        if kind != 'multiple_polygons':
+            sample.update(M=truth.M, points=truth.points(), template_points=truth.template_points())
+            if not ground_truth:
+                sample['template'] = truth.rasterize('template', template_buffer)
+        if ground_truth:
+            sample['ground_truth'] = truth
+        if pyramid_levels > 1:
+            sample['pyramid'] = sample_pyramid(sample, truth, pyramid_levels)
+        return sample
+    if kind == 'multiple_polygons':
+        GENERATORS[kind](img, **kwargs)
+        return sample
+    if kind != 'lines':
+        kwargs['full_output'] = True
+    points, template_points, template_img, M = GENERATORS[kind](img, template_img=template_buffer,
+                                                                **kwargs)
+    if points is None:
+        return None
+    sample.update(template=template_img, M=M, points=points,
+                  template_points=template_points)
+    return sample
+
+
+def sample_pyramid(sample, truth, levels):
+    """ Return the pyramid of a sample: the levels of the image, built with
+    one cv.pyrDown chain, and of the template, rasterized again from the
+    vector ground truth at each level so that they stay binary. The templates
+    are None when the sample keeps its ground truth instead, and for
+    'multiple_polygons'. The first level is the sample itself.
+    Parameters:
+      truth: ShapeGroundTruth of the sample
+      levels: number of levels, including the full resolution one
+    """
+    templates = None
+    if sample['template'] is not None:
+        templates = [sample['template']] + [truth.rasterize('template', level=level)
+                                            for level in range(1, levels)]
+    return {'images': shapes.build_pyramid(sample['image'], levels), 'templates': templates}
+
+
+def pyramid_level(sample, level):
+    """ Return the image, template, transform and keypoints of a sample at a
+    level of its pyramid, where the coordinates are divided by 2 ** level.
+    Only M of the full resolution is stored, the one of the level is derived
+    from it: S M S^-1 with S = diag(2^-level, 2^-level, 1). The template is
+    rasterized from the ground truth when the sample keeps it instead.
+    """
+    pyramid = sample['pyramid']
+    if level >= len(pyramid['images']):
+        raise ValueError('The pyramid of sample %d has %d levels, got level %d'
+                         % (sample['index'], len(pyramid['images']), level))
+    template = None
+    if pyramid['templates'] is not None:
+        template = pyramid['templates'][level]
+    elif sample['ground_truth'] is not None and sample['kind'] != 'multiple_polygons':
+        template = sample['ground_truth'].rasterize('template', level=level)
+    scale = 0.5 ** level
+    level_sample = {'index': sample['index'], 'kind': sample['kind'], 'level': level,
+                    'image': pyramid['images'][level], 'template': template,
+                    'M': None, 'points': None, 'template_points': None}
+    if sample['M'] is not None:
+        level_sample.update(M=shapes.scale_transform(sample['M'], level),
+                            points=sample['points'] * scale,
+                            template_points=sample['template_points'] * scale)
+    return level_sample
+
+
+def generate_sample(kind, index, base_seed=0, size=(480, 640), background=True,
+                    frame_pool=None, out=None, ground_truth=False, pyramid_levels=1, **kwargs):
+    """ Render one sample and return it as a dict, or None if the generator failed.
+    The dict holds the image, the template, the inverse transform M, the
+    keypoints of the image and of the template, the last four being None for
+    'multiple_polygons', which has no template, and the ground truth.
+    Parameters:
+      kind: name of the generator, one of GENERATORS
+      index: index of the sample in the dataset
+      base_seed: seed of the whole dataset
+      size: size of the image
+      background: draw the shapes on generate_background() instead of a black
+                  image, or on background(size, out=frame) if it is callable
+      frame_pool: FramePool the image and template frames are taken from, the
+                  caller releases them once the sample is consumed
+      out: (image, template) preallocated frames to draw into, instead of frame_pool
+      ground_truth: keep the vector ShapeGroundTruth of the sample and leave
+                    the template to be rasterized from it on demand, the
+                    template is None
+      pyramid_levels: number of levels of the pyramid of the image and of the
+                      template stored under 'pyramid', see sample_pyramid()
+                      and pyramid_level(), 1 for no pyramid
+      kwargs: extra parameters of the generator
+    """
+    img = template_buffer = None
+    if out is not None:
+        img, template_buffer = out
+    elif frame_pool is not None:
+        img, template_buffer = frame_pool.acquire(), frame_pool.acquire()
+    sample, state = start_sample(kind, index, base_seed, size, background, img)
+    result = finish_sample(sample, state, template_buffer, ground_truth, pyramid_levels, **kwargs)
+    if out is None and frame_pool is not None:
+        if result is None:
+            frame_pool.release(sample['image'], template_buffer)
+        elif result['template'] is not template_buffer:
+            frame_pool.release(template_buffer)
+    return result
+
+
+def generate_scene(index, base_seed=0, size=(480, 640), background=True, **kwargs):
+    """ Render a scene of mixed shapes with shapes.compose_scene() and return
+    it as a sample dict holding the image, the (H, W) uint16 instance map and
+    the Scene, whose shapes have their own templates and transforms, or None
+    if no shape could be placed. The other parameters are those of generate_sample().
+    """
+    sample, state = start_sample('scene', index, base_seed, size, background)
+    shapes.set_random_state(state)
+    scene = shapes.compose_scene(sample['image'], **kwargs)
+    if scene is None:
+        return None
+    sample.update(scene=scene, instances=scene.instances)
+    return sample
+
+
+def check_kinds(kind):
+    """ Validate a generator name or a {name: weight} mixture of generators """
+    kinds = kind if isinstance(kind, dict) else {kind: 1}
+    for name in kinds:
+        if name not in GENERATORS:
+            raise ValueError('Unknown generator %r, expected one of %s' % (name, sorted(GENERATORS)))
+    if isinstance(kind, dict) and (min(kinds.values()) < 0 or sum(kinds.values()) <= 0):
+        raise ValueError('Invalid mixture weights %s' % kinds)
+
+
+def mixture_kind(mixture, base_seed, index):
+    """ Return the generator drawn for the sample 'index' from a {name: weight}
+    mixture, independently of the state the sample is rendered with """
+    names = sorted(mixture)
+    weights = np.array([mixture[name] for name in names], dtype=float)
+    u = np.random.RandomState([base_seed, index, 1]).rand()
+    return names[min(int(np.searchsorted(np.cumsum(weights) / weights.sum(), u, side='right')),
+                     len(names) - 1)]
+
+
+def generate_mixture_sample(mixture, index, base_seed=0, **kwargs):
+    """ generate_sample() with the generator drawn from a {name: weight} mixture """
+    return generate_sample(mixture_kind(mixture, base_seed, index), index, base_seed, **kwargs)
+
+
+def ignore_interrupts():
+    """ Initializer of the worker processes: Ctrl-C is only handled by the
+    parent, which then terminates the pool, instead of by every worker """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def generate_dataset(kind, num_samples, base_seed=0, num_workers=None, start=0,
+                     chunksize=8, **kwargs):
+    """ Generate the samples start, ..., start + num_samples - 1 over a process pool
+    and yield them in index order. Failed samples are skipped.
+    Parameters:
+      kind: name of the generator, one of GENERATORS, or a {name: weight} dict
+            to draw the generator of every sample from a mixture
+      num_samples: number of samples to render
+      base_seed: seed of the whole dataset
+      num_workers: number of processes, all the cores by default, 1 renders in process
+      start: index of the first sample
+      chunksize: number of samples sent to a worker at once
+      kwargs: extra parameters of generate_sample, given to every generator of a mixture
+    """
+    check_kinds(kind)
+    if isinstance(kind, dict):
+        render = partial(generate_mixture_sample, kind, base_seed=base_seed, **kwargs)
+    else:
+        render = partial(generate_sample, kind, base_seed=base_seed, **kwargs)
+    indices = range(start, start + num_samples)
+    num_workers = num_workers or multiprocessing.cpu_count()
+    if num_workers == 1:
+        samples = map(render, indices)
+        for sample in samples:
+            if sample is not None:
+                yield sample
+        return
+    with multiprocessing.Pool(num_workers, initializer=ignore_interrupts) as pool:
+        for sample in pool.imap(render, indices, chunksize):
+            if sample is not None:
+                yield sample
+
+
+def point_capacity(kind, **kwargs):
+    """ Maximal number of keypoints of a sample of the generator 'kind' """
+    if kind == 'lines':
+        return 2 * (kwargs.get('nb_lines', 10) - 1)
+    if kind == 'polygon':
+        return kwargs.get('max_sides', 15)
+    if kind == 'contours':
+        return kwargs.get('max_n', 20) * 200  # 200 points per Bezier segment
+    if kind == 'ellipses':
+        return 1
+    return 0
+
+
+def generate_batch(kind, batch_size, size=(480, 640), seed=0, max_points=None, out=None,
+                   max_failures=None, augment=None, **kwargs):
+    """ Render a batch of samples into stacked arrays. Failed samples are
+    dropped and replaced by the next sample indices, so the batch is always full.
+    Parameters:
+      kind: name of the generator, one of GENERATORS
+      batch_size: number of samples
+      size: size of the images
+      seed: base seed, sample k of the batch is rendered from (seed, index)
+            with increasing indices starting at 0
+      max_points: capacity of the keypoint arrays, by default the largest
+                  number of keypoints the generator can output
+      out: a batch returned by a previous call, whose arrays are reused
+      max_failures: maximal number of failed samples before giving up,
+                    10 * batch_size by default
+      augment: BatchAugmenter applied to the images once the batch is full,
+               drawing from its own stream of the seed
+      kwargs: extra parameters of generate_sample and of the generator
+    Returns a dict of arrays:
+      images, templates: (B, H, W) uint8
+      M: (B, 3, 3) inverse transforms, identity for 'multiple_polygons'
+      points, template_points: (B, max_points, 2) int32, zero padded
+      point_counts: (B,) number of keypoints of each sample
+      indices: (B,) sample index each sample was rendered from
+    """
+    if kind not in GENERATORS:
+        raise ValueError('Unknown generator %r, expected one of %s' % (kind, sorted(GENERATORS)))
+    max_points = point_capacity(kind, **kwargs) if max_points is None else max_points
+    max_failures = 10 * batch_size if max_failures is None else max_failures
+    size = tuple(size)
+    if (out is None or out['images'].shape != (batch_size,) + size
+            or out['points'].shape[1] != max_points):
+        out = {'images': np.empty((batch_size,) + size, np.uint8),
+               'templates': np.empty((batch_size,) + size, np.uint8),
+               'M': np.empty((batch_size, 3, 3)),
+               'points': np.empty((batch_size, max_points, 2), np.int32),
+               'template_points': np.empty((batch_size, max_points, 2), np.int32),
+               'point_counts': np.empty(batch_size, np.int64),
+               'indices': np.empty(batch_size, np.int64)}
+    out['points'][...] = 0
+    out['template_points'][...] = 0
+    index = failures = 0
+    for k in range(batch_size):
+        while True:
+            sample = generate_sample(kind, index, seed, size,
+                                     out=(out['images'][k], out['templates'][k]), **kwargs)
+            index += 1
+            if sample is not None:
+                break
+            failures += 1
+            if failures > max_failures:
+                raise RuntimeError('%s failed %d times while rendering a batch of %d'
+                                   % (kind, failures, batch_size))
+        out['indices'][k] = sample['index']
+        if sample['M'] is None:  # multiple_polygons, no template
+            out['templates'][k] = 0
+            out['M'][k] = np.eye(3)
+            out['point_counts'][k] = 0
+            continue
+        if sample['template'] is None:  # ground truth only
+            sample['ground_truth'].rasterize('template', out['templates'][k])
+        out['M'][k] = sample['M']
+        count = min(len(sample['points']), max_points)
+        out['point_counts'][k] = count
+        out['points'][k, :count] = sample['points'][:count]
+        out['template_points'][k, :count] = sample['template_points'][:count]
+    if augment is not None:
+        augment(out['images'], state=np.random.RandomState([seed, int(out['indices'][0]), 2]))
+    return out
+
+
+def generate_shards(root, kind, num_samples, base_seed=0, size=(480, 640), shard_size=1024,
+                    num_workers=None, threads=None, round_size=4096, log=None, **kwargs):
+    """ Generate num_samples successful samples into a sharded dataset (see
+    shape_shards), resuming the run already in 'root' if there is one. Every
+    completed shard is indexed, so a killed run restarts after its last
+    completed shard and produces the same dataset as an uninterrupted one.
+    Parameters:
+      root: directory of the dataset
+      kind: name of the generator or {name: weight} mixture, see generate_dataset
+      num_samples: number of samples of the dataset, failed samples do not count
+      base_seed: seed of the whole dataset
+      size: size of the images
+      shard_size: number of samples per shard
+      num_workers: number of processes, all the cores by default
+      threads: render in this process with a threaded shape_pipeline of that
+               many threads per stage, or a dict of them, instead of a process pool
+      round_size: minimal number of sample indices submitted to the pool at once
+      log: function called with a progress message after every shard
+      kwargs: extra parameters of generate_sample, with ground_truth=True the
+              templates are not stored but rasterized when read, with
+              pyramid_levels the levels of the pyramids are stored too
+    Returns the index of the dataset
+    """
+    check_kinds(kind)
+    job = json.loads(json.dumps({'kind': kind, 'num_samples': num_samples, 'seed': base_seed,
+                                 'size': size, 'kwargs': kwargs}))
+    with ShardWriter(root, size, shard_size, resume=True,
+                     store_templates=not kwargs.get('ground_truth'),
+                     pyramid_levels=kwargs.get('pyramid_levels', 1)) as writer:
+        if writer.index.setdefault('job', job) != job:
+            raise ValueError('%s holds the dataset of another job: %s' % (root, writer.index['job']))
+        written = writer.index['num_samples']
+        index = writer.next_index()
+        while written < num_samples:
+            requested = max(num_samples - written, round_size)
+            rendered = 0
+            if threads:
+                from shape_pipeline import sample_pipeline
+                samples = sample_pipeline(kind, requested, base_seed, size, threads=threads,
+                                          start=index, **kwargs)
+            else:
+                samples = generate_dataset(kind, requested, base_seed, num_workers, start=index,
+                                           size=size, **kwargs)
+            for sample in samples:
+                writer.write(sample)
+                written += 1
+                rendered += 1
+                if writer.shard_dir is None and log is not None:  # a shard was completed
+                    log('%d / %d samples, %d shards' % (written, num_samples,
+                                                        len(writer.index['shards'])))
+                if written == num_samples:
+                    break
+            samples.close()  # stop the workers of a round cut short
+            if rendered == 0:
+                raise RuntimeError('%s failed on all the samples %d to %d'
+                                   % (kind, index, index + requested - 1))
+            index += requested
+    return writer.index
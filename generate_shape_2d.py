@@ -1,21 +1,57 @@
 
-import random
+from functools import lru_cache
+from math import comb
 
 import numpy as np
-from scipy.special import binom
-import matplotlib.pyplot as plt
 import cv2
 
-bernstein = lambda n, k, t: binom(n, k) * t ** k * (1. - t) ** (n - k)
+from shape_profiling import SamplingStats, profiler, sampling_stats
 
+bernstein = lambda n, k, t: comb(n, k) * t ** k * (1. - t) ** (n - k)
 
-def bezier(points, num=200):
-    N = len(points)
+
+@lru_cache(maxsize=None)
+def bernstein_basis(num_control, num=200):
+    """ Return the (num, num_control) Bernstein basis matrix, cached so that
+    every curve with the same degree and resolution shares it """
     t = np.linspace(0, 1, num=num)
-    curve = np.zeros((num, 2))
-    for i in range(N):
-        curve += np.outer(bernstein(N - 1, i, t), points[i])
-    return curve
+    basis = np.stack([bernstein(num_control - 1, k, t) for k in range(num_control)], axis=1)
+    basis.setflags(write=False)
+    return basis
+
+
+def bezier(points, num=200):
+    return bernstein_basis(len(points), num) @ np.asarray(points, dtype=float)
+
+
+def bezier_batch(control_points, num=200):
+    """ Evaluate S Bezier curves at once
+    Parameters:
+      control_points: (S, N, 2) array of control points
+      num: number of samples per curve
+    Returns a (S, num, 2) array """
+    control_points = np.asarray(control_points, dtype=float)
+    return np.matmul(bernstein_basis(control_points.shape[1], num), control_points)
+
+
+def segment_control_points(points, r=0.3):
+    """ Compute the cubic control points of all the segments of a closed curve
+    Parameters:
+      points: (S + 1, 3) array of (x, y, angle), the last row closing the curve
+      r: distance of the intermediate control points, relative to the segment length
+    Returns a (S, 4, 2) array """
+    p1, p2 = points[:-1, :2], points[1:, :2]
+    angle1, angle2 = points[:-1, 2], points[1:, 2]
+    d = r * np.sqrt(np.sum((p2 - p1) ** 2, axis=1))
+    p = np.empty((len(p1), 4, 2))
+    p[:, 0] = p1
+    p[:, 1, 0] = p1[:, 0] + d * np.cos(angle1)
+    p[:, 1, 1] = p1[:, 1] + d * np.sin(angle1)
+    p[:, 2, 0] = p2[:, 0] + d * np.cos(angle2 + np.pi)
+    p[:, 2, 1] = p2[:, 1] + d * np.sin(angle2 + np.pi)
+    p[:, 3] = p2
+    return p
+
 
 class Segment():
     def __init__(self, p1, p2, angle1, angle2, **kw):
@@ -40,28 +76,34 @@ class Segment():
         self.curve = bezier(self.p, self.numpoints)
 
 class Curves():
-    def __init__(self, n):
-        np.random.seed(10)
-        self.rad = 0.2
-        self.edgy = np.random.rand()
+    def __init__(self, n, rad=0.2, edgy=None, mindst=None):
+        self.rad = rad
+        self.edgy = random_state.rand()  # drawn even when set, to keep the random stream
+        if edgy is not None:
+            self.edgy = edgy
+        self.mindst = mindst
         self.n = n
 
     def get_point(self,min_x, max_x, min_y, max_y):
-        a = self.get_random_points(n=self.n, scale=1)
-        x, y, _ = self.get_bezier_curve(a, rad=self.rad, edgy=self.edgy)
-        x = x * (max_x-min_x) + min_x
-        y = y * (max_y-min_y) + min_y
-        points = np.array(np.concatenate((x.reshape(-1,1), y.reshape(-1,1)), axis=1)) # N,2
-        return points
+        control_points = self.get_control_points(min_x, max_x, min_y, max_y)
+        return bezier_batch(control_points).reshape(-1, 2)  # N,2
+
+    @profiler.timed('sampling')
+    def get_control_points(self, min_x, max_x, min_y, max_y):
+        """ Return the (S, 4, 2) cubic control points of a random closed curve
+        in the box [min_x, max_x] x [min_y, max_y] """
+        a = self.get_random_points(n=self.n, scale=1, mindst=self.mindst)
+        a = self.get_curve_points(a, edgy=self.edgy)
+        control_points = segment_control_points(a, self.rad)
+        return control_points * [max_x - min_x, max_y - min_y] + [min_x, min_y]
 
 
     def get_curve(self, points, **kw):
-        segments = []
-        for i in range(len(points) - 1):
-            seg = Segment(points[i, :2], points[i + 1, :2], points[i, 2], points[i + 1, 2], **kw)
-            segments.append(seg)
-        curve = np.concatenate([s.curve for s in segments])
-        return segments, curve
+        """ Evaluate all the segments of the closed curve in one batch and
+        return their (S, 4, 2) control points and the (S * numpoints, 2) curve """
+        control_points = segment_control_points(points, kw.get("r", 0.3))
+        curve = bezier_batch(control_points, kw.get("numpoints", 200))
+        return control_points, curve.reshape(-1, 2)
 
     def ccw_sort(self, p):
         d = p - np.mean(p, axis=0)
@@ -75,6 +117,14 @@ class Curves():
               control points.
         *edgy* is a parameter which controls how "edgy" the curve is,
                edgy=0 is smoothest."""
+        a = self.get_curve_points(a, edgy)
+        s, c = self.get_curve(a, r=rad, method="var")
+        x, y = c.T
+        return x, y, a
+
+    def get_curve_points(self, a, edgy=0):
+        """ Sort the points *a* counter-clockwise, close the curve and append
+        the angle of the curve at each point as a third column """
         p = np.arctan(edgy) / np.pi + .5
         a = self.ccw_sort(a)
         a = np.append(a, np.atleast_2d(a[0, :]), axis=0)
@@ -86,21 +136,27 @@ class Curves():
         ang2 = np.roll(ang, 1)
         ang = p * ang1 + (1 - p) * ang2 + (np.abs(ang2 - ang1) > np.pi) * np.pi
         ang = np.append(ang, [ang[0]])
-        a = np.append(a, np.atleast_2d(ang).T, axis=1)
-        s, c = self.get_curve(a, r=rad, method="var")
-        x, y = c.T
-        return x, y, a
+        return np.append(a, np.atleast_2d(ang).T, axis=1)
 
-    def get_random_points(self, n=5, scale=0.8, mindst=None, rec=0):
+    def get_random_points(self, n=5, scale=0.8, mindst=None, batch_size=16, max_tries=200):
         """ create n random points in the unit square, which are *mindst*
-        apart, then scale them."""
+        apart, then scale them.
+        Candidate point sets are drawn and tested *batch_size* at a time, the
+        first valid one is returned, or the last one after *max_tries* candidates."""
         mindst = mindst or .7 / n
-        a = np.random.rand(n, 2)
-        d = np.sqrt(np.sum(np.diff(self.ccw_sort(a), axis=0), axis=1) ** 2)
-        if np.all(d >= mindst) or rec >= 200:
-            return a * scale
-        else:
-            return self.get_random_points(n=n, scale=scale, mindst=mindst, rec=rec + 1)
+        for start in range(0, max_tries, batch_size):
+            a = random_state.rand(min(batch_size, max_tries - start), n, 2)
+            d = a - np.mean(a, axis=1, keepdims=True)
+            order = np.argsort(np.arctan2(d[:, :, 0], d[:, :, 1]), axis=1)
+            sorted_a = np.take_along_axis(a, order[:, :, None], axis=1)
+            d = np.sqrt(np.sum(np.diff(sorted_a, axis=1), axis=2) ** 2)
+            valid = np.all(d >= mindst, axis=1)
+            profiler.count('get_random_points.batches')
+            sampling_stats.record('get_random_points', len(a), np.sum(valid))
+            if np.any(valid):
+                return a[np.argmax(valid)] * scale
+        sampling_stats.record_failure('get_random_points')
+        return a[-1] * scale
 
     def draw_plot(self,x, y):
         img = np.zeros((480, 640), np.uint8)
@@ -111,19 +167,31 @@ class Curves():
 
 """ Module used to generate geometrical synthetic shapes """
 import os.path
-import random
+import threading
+from collections import OrderedDict
 
 import cv2
 import cv2 as cv
 import numpy as np
 import math
 
-random_state = np.random.RandomState(None)
+class ThreadRandomState(threading.local):
+    """ Forward the calls to the RandomState of the calling thread, so that
+    threads can render samples concurrently, each from its own state """
+
+    def __init__(self):
+        self.state = np.random.RandomState(None)
+
+    def __getattr__(self, name):
+        return getattr(self.state, name)
+
+
+random_state = ThreadRandomState()
 
 
 def set_random_state(state):
-    global random_state
-    random_state = state
+    """ Draw the random numbers of the calling thread from 'state' """
+    random_state.state = state
 
 
 def get_random_color(background_color):
@@ -151,30 +219,116 @@ def get_different_color(previous_colors, min_dist=50, max_count=20):
     return color
 
 
+@profiler.timed('blur')
 def add_salt_and_pepper(img):
-    """ Add salt and pepper noise to an image """
-    noise = np.zeros((img.shape[0], img.shape[1]), dtype=np.uint8)
-    cv.randu(noise, 0, 255)
+    """ Add salt and pepper noise to an image
+    Returns the keypoints created by the noise, an empty (0, 2) array """
+    noise = random_state.randint(0, 255, size=img.shape[:2], dtype=np.uint8)
     black = noise < 30
     white = noise > 225
     img[white > 0] = 255
     img[black > 0] = 0
     cv.blur(img, (5, 5), img)
-    return np.empty((0, 2), dtype=np.int)
+    return np.empty((0, 2), dtype=int)
 
 
-def generate_background_steel(background_path='/home/gzr/Data/generative_steel/train', size=(960, 1280), max_id=10000):
-    img_id = random.randint(0, max_id - 1)
-    img_path = os.path.join(background_path, '%05d' % img_id + '.jpg')
-    img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
-    img = cv2.resize(img, dsize=(2400, 640))
-    crop_rand_0 = random.randint(0, img.shape[0] - size[0])
-    crop_rand_1 = random.randint(0, img.shape[1] - size[1])
-    return img[crop_rand_0:crop_rand_0 + size[0], crop_rand_1:crop_rand_1 + size[1]]
+STEEL_BACKGROUND_PATH = os.environ.get('STEEL_BACKGROUND_PATH', '/home/gzr/Data/generative_steel/train')
 
 
+class BackgroundBank():
+    """ Decode and resize background textures once, keep them in an LRU cache
+    and serve random crops of them
+    Parameters:
+      background_path: directory holding the images %05d.jpg
+      max_id: number of images in the directory
+      image_ids: ids of the subset of images to draw from, by default
+                 cache_size ids drawn with 'seed', so that every image is
+                 decoded once and then served from the cache
+      resize: (width, height) the images are resized to after decoding
+      cache_size: maximal number of decoded images kept in memory
+      seed: seed of the default subset of images
+    """
+
+    def __init__(self, background_path=STEEL_BACKGROUND_PATH, max_id=10000, image_ids=None,
+                 resize=(2400, 640), cache_size=64, seed=0):
+        self.background_path = background_path
+        if image_ids is None:
+            image_ids = np.sort(np.random.RandomState(seed).choice(max_id, min(max_id, cache_size),
+                                                                   replace=False))
+        self.image_ids = [int(img_id) for img_id in image_ids]
+        self.resize = tuple(resize)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, img_id):
+        """ Return the decoded and resized image img_id, read-only """
+        with self.lock:
+            if img_id in self.cache:
+                self.cache.move_to_end(img_id)
+                return self.cache[img_id]
+        img_path = os.path.join(self.background_path, '%05d' % img_id + '.jpg')
+        img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            raise IOError('Cannot read the background image %s' % img_path)
+        img = cv2.resize(img, dsize=self.resize)
+        img.setflags(write=False)
+        with self.lock:
+            self.cache[img_id] = img
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return img
+
+    def preload(self):
+        """ Decode the images up to the cache size, e.g. before forking workers
+        that will then share them """
+        for img_id in self.image_ids[:self.cache_size]:
+            self.get(img_id)
+
+    def crop(self, size=(960, 1280), out=None):
+        """ Copy a random crop of size 'size' of a random image, into 'out' if given """
+        if size[0] > self.resize[1] or size[1] > self.resize[0]:
+            raise ValueError('Cannot crop %dx%d backgrounds out of textures resized to %dx%d'
+                             % (size[0], size[1], self.resize[1], self.resize[0]))
+        img = self.get(self.image_ids[random_state.randint(len(self.image_ids))])
+        crop_rand_0 = random_state.randint(img.shape[0] - size[0] + 1)
+        crop_rand_1 = random_state.randint(img.shape[1] - size[1] + 1)
+        crop = img[crop_rand_0:crop_rand_0 + size[0], crop_rand_1:crop_rand_1 + size[1]]
+        if out is None:
+            return crop.copy()
+        out[...] = crop
+        return out
+
+
+background_banks = {}
+
+
+@profiler.timed('background')
+def generate_background_steel(background_path=STEEL_BACKGROUND_PATH, size=(640, 1280), max_id=10000,
+                              image_ids=None, cache_size=64, bank=None, out=None):
+    """ Crop a background out of a real steel texture
+    Parameters:
+      background_path: directory of the textures, STEEL_BACKGROUND_PATH by default
+      size: size of the image, at most the 640x2400 the textures are resized to
+      max_id: number of textures in the directory
+      image_ids: ids of the textures to crop from, see BackgroundBank
+      cache_size: number of decoded textures kept in memory
+      bank: BackgroundBank to crop from, by default one shared per
+            (background_path, max_id, image_ids, cache_size) so every texture is decoded once
+      out: preallocated uint8 image of size 'size' to copy the crop into
+    """
+    if bank is None:
+        key = (background_path, max_id, None if image_ids is None else tuple(image_ids), cache_size)
+        bank = background_banks.get(key)
+        if bank is None:  # setdefault keeps a single bank if threads race here
+            bank = background_banks.setdefault(key, BackgroundBank(background_path, max_id, image_ids,
+                                                                   cache_size=cache_size))
+    return bank.crop(size, out)
+
+
+@profiler.timed('background')
 def generate_background(size=(960, 1280), nb_blobs=100, min_rad_ratio=0.01,
-                        max_rad_ratio=0.05, min_kernel_size=50, max_kernel_size=300):
+                        max_rad_ratio=0.05, min_kernel_size=50, max_kernel_size=300, out=None):
     """ Generate a customized background image
     Parameters:
       size: size of the image
@@ -183,10 +337,13 @@ def generate_background(size=(960, 1280), nb_blobs=100, min_rad_ratio=0.01,
       max_rad_ratio: the radius of blobs is at most max_rad_size * max(size)
       min_kernel_size: minimal size of the kernel
       max_kernel_size: maximal size of the kernel
+      out: preallocated uint8 image of size 'size' to draw into
     """
-    img = np.zeros(size, dtype=np.uint8)
-    dim = max(size)
+    img = np.empty(size, dtype=np.uint8) if out is None else out
+    # seed OpenCV's RNG from random_state to stay reproducible
+    cv.setRNGSeed(int(random_state.randint(2 ** 31)))
     cv.randu(img, 0, 255)
+    dim = max(size)
     cv.threshold(img, random_state.randint(256), 255, cv.THRESH_BINARY, img)
     background_color = int(np.mean(img))
     blobs = np.concatenate([random_state.randint(0, size[1], size=(nb_blobs, 1)),
@@ -195,7 +352,7 @@ def generate_background(size=(960, 1280), nb_blobs=100, min_rad_ratio=0.01,
     for i in range(nb_blobs):
         col = get_random_color(background_color)
         cv.circle(img, (blobs[i][0], blobs[i][1]),
-                  np.random.randint(int(dim * min_rad_ratio),
+                  random_state.randint(int(dim * min_rad_ratio),
                                     int(dim * max_rad_ratio)),
                   col, -1)
     kernel_size = random_state.randint(min_kernel_size, max_kernel_size)
@@ -203,28 +360,174 @@ def generate_background(size=(960, 1280), nb_blobs=100, min_rad_ratio=0.01,
     return img
 
 
+@profiler.timed('background')
 def generate_custom_background(size, background_color, nb_blobs=3000,
-                               kernel_boundaries=(50, 100)):
+                               kernel_boundaries=(50, 100), out=None):
     """ Generate a customized background to fill the shapes
     Parameters:
       background_color: average color of the background image
       nb_blobs: number of circles to draw
       kernel_boundaries: interval of the possible sizes of the kernel
+      out: preallocated uint8 image of size 'size' to draw into
     """
-    img = np.zeros(size, dtype=np.uint8)
-    img = img + get_random_color(background_color)
-    blobs = np.concatenate([np.random.randint(0, size[1], size=(nb_blobs, 1)),
-                            np.random.randint(0, size[0], size=(nb_blobs, 1))],
+    img = np.empty(size, dtype=np.uint8) if out is None else out
+    img[...] = get_random_color(background_color)
+    blobs = np.concatenate([random_state.randint(0, size[1], size=(nb_blobs, 1)),
+                            random_state.randint(0, size[0], size=(nb_blobs, 1))],
                            axis=1)
     for i in range(nb_blobs):
         col = get_random_color(background_color)
         cv.circle(img, (blobs[i][0], blobs[i][1]),
-                  np.random.randint(20), col, -1)
-    kernel_size = np.random.randint(kernel_boundaries[0], kernel_boundaries[1])
+                  random_state.randint(20), col, -1)
+    kernel_size = random_state.randint(kernel_boundaries[0], kernel_boundaries[1])
     cv.blur(img, (kernel_size, kernel_size), img)
     return img
 
 
+def get_random_colors(background_color, n):
+    """ Output n random scalars in grayscale, as get_random_color does """
+    colors = random_state.randint(256, size=n)
+    low_contrast = np.abs(colors - background_color) < 40
+    colors[low_contrast] = (colors[low_contrast] + 128) % 256
+    return colors
+
+
+def splat_disks(img, centers, rads, colors):
+    """ Fill disks into img as successive cv.circle calls would, but with
+    one vectorized pass per distinct radius instead of one call per disk:
+    every pixel takes the color of the last disk covering it
+    Parameters:
+      centers: (n, 2) integer centers (x, y)
+      rads: (n,) integer radii
+      colors: (n,) colors
+    """
+    h, w = img.shape[:2]
+    last = np.full((h, w), -1, dtype=np.int32)
+    group = np.empty((h, w), dtype=np.int32)
+    for rad in np.unique(rads):
+        dy, dx = np.mgrid[-rad:rad + 1, -rad:rad + 1]
+        disk = dx ** 2 + dy ** 2 <= rad ** 2
+        ids = np.flatnonzero(rads == rad)
+        xs = centers[ids, 0, None] + dx[disk][None, :]
+        ys = centers[ids, 1, None] + dy[disk][None, :]
+        inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+        # ids are increasing, so the assignment leaves the last disk of the group
+        group.fill(-1)
+        group[ys[inside], xs[inside]] = np.broadcast_to(ids[:, None], xs.shape)[inside]
+        np.maximum(last, group, out=last)
+    covered = last >= 0
+    img[covered] = np.asarray(colors)[last[covered]]
+    return img
+
+
+def downscale_factor(kernel_size, max_factor=8, min_kernel_size=16):
+    """ Largest factor the blobs can be rendered smaller by, keeping a blur
+    kernel of at least min_kernel_size pixels at the reduced resolution """
+    return int(min(max(kernel_size // min_kernel_size, 1), max_factor))
+
+
+@profiler.timed('background')
+def generate_background_fast(size=(960, 1280), nb_blobs=100, min_rad_ratio=0.01,
+                             max_rad_ratio=0.05, min_kernel_size=50, max_kernel_size=300,
+                             max_factor=8, out=None):
+    """ Generate a background statistically similar to generate_background()
+    at a fraction of the cost: the blobs are splatted all at once at a
+    resolution reduced according to the blur kernel, then blurred and
+    upsampled to 'size'. From 480x640 up, the mean gradient and the contrast
+    are within 5% of those of generate_background(); smaller images have
+    blobs of a few pixels that come out with about 20% more contrast.
+    Parameters:
+      see generate_background()
+      max_factor: maximal downscaling factor
+    """
+    dim = max(size)
+    threshold = random_state.randint(256)
+    kernel_size = random_state.randint(min_kernel_size, max_kernel_size)
+    factor = downscale_factor(kernel_size, max_factor)
+    small_size = (-(-size[0] // factor), -(-size[1] // factor))
+    small = np.empty(small_size, dtype=np.uint8)
+    cv.setRNGSeed(int(random_state.randint(2 ** 31)))
+    if factor == 1:
+        cv.randu(small, 0, 255)
+        cv.threshold(small, threshold, 255, cv.THRESH_BINARY, small)
+    else:
+        # a pixel stands for the mean of factor x factor pixels of binary
+        # noise, whose deviation is factor times lower than the full resolution one
+        p = max(254 - threshold, 0) / 255
+        cv.randn(small, 255 * p, 255 * math.sqrt(p * (1 - p)) / factor)
+    background_color = int(np.mean(small))
+    centers = np.stack([random_state.randint(0, size[1], size=nb_blobs),
+                        random_state.randint(0, size[0], size=nb_blobs)], axis=1)
+    rads = random_state.randint(int(dim * min_rad_ratio), int(dim * max_rad_ratio), size=nb_blobs)
+    splat_disks(small, centers // factor, np.rint(rads / factor).astype(int),
+                get_random_colors(background_color, nb_blobs))
+    small_kernel = max(kernel_size // factor, 1)
+    cv.blur(small, (small_kernel, small_kernel), small)
+    img = np.empty(size, dtype=np.uint8) if out is None else out
+    return cv.resize(small, (size[1], size[0]), img, interpolation=cv.INTER_LINEAR)
+
+
+@profiler.timed('background')
+def generate_custom_background_fast(size, background_color, nb_blobs=3000,
+                                    kernel_boundaries=(50, 100), max_factor=8, out=None):
+    """ Generate a custom background statistically similar to
+    generate_custom_background(), see generate_background_fast()
+    Parameters:
+      see generate_custom_background()
+      max_factor: maximal downscaling factor
+    """
+    kernel_size = random_state.randint(kernel_boundaries[0], kernel_boundaries[1])
+    factor = downscale_factor(kernel_size, max_factor)
+    small = np.empty((-(-size[0] // factor), -(-size[1] // factor)), dtype=np.uint8)
+    small[...] = get_random_color(background_color)
+    centers = np.stack([random_state.randint(0, size[1], size=nb_blobs),
+                        random_state.randint(0, size[0], size=nb_blobs)], axis=1)
+    rads = random_state.randint(20, size=nb_blobs)
+    splat_disks(small, centers // factor, np.rint(rads / factor).astype(int),
+                get_random_colors(background_color, nb_blobs))
+    small_kernel = max(kernel_size // factor, 1)
+    cv.blur(small, (small_kernel, small_kernel), small)
+    img = np.empty(size, dtype=np.uint8) if out is None else out
+    return cv.resize(small, (size[1], size[0]), img, interpolation=cv.INTER_LINEAR)
+
+
+def black_frame(img, out=None):
+    """ Return a black uint8 frame of the size of img, zeroing 'out' if given """
+    if out is None:
+        return np.zeros(img.shape[:2], np.uint8)
+    out[...] = 0
+    return out
+
+
+class FramePool():
+    """ Recycle (H, W) uint8 frames instead of allocating new ones
+    Parameters:
+      size: (H, W) of the frames
+      max_free: maximal number of released frames kept for reuse
+    Acquired frames are not initialized. """
+
+    def __init__(self, size, max_free=64):
+        self.size = tuple(size)
+        self.max_free = max_free
+        self.free = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+        return np.empty(self.size, np.uint8)
+
+    def release(self, *frames):
+        """ Hand frames back to the pool, None and foreign frames are ignored """
+        with self.lock:
+            for frame in frames:
+                if (isinstance(frame, np.ndarray) and frame.shape == self.size
+                        and frame.dtype == np.uint8 and len(self.free) < self.max_free):
+                    self.free.append(frame)
+
+
+@profiler.timed('blur')
 def final_blur(img, kernel_size=(5, 5)):
     """ Apply a final Gaussian blur to the image
     Parameters:
@@ -233,6 +536,89 @@ def final_blur(img, kernel_size=(5, 5)):
     cv.GaussianBlur(img, kernel_size, 0, img)
 
 
+class BatchAugmenter():
+    """ Augment a (N, H, W) uint8 stack of images in place with, per image:
+    salt and pepper noise followed by a 5x5 box blur, as add_salt_and_pepper()
+    does, a brightness and contrast jitter, and a Gaussian blur with a kernel
+    size drawn from 'kernel_sizes'. The noise is drawn for the whole stack at
+    once into buffers kept between calls.
+    Parameters:
+      noise_level: range of the fraction of black and of white pixels, in
+                   1/256th, add_salt_and_pepper() uses 30
+      brightness: range of the intensity offset
+      contrast: range of the contrast factor, applied around the mean intensity
+      kernel_sizes: sizes the Gaussian kernel is drawn from, 1 for no blur
+    """
+
+    def __init__(self, noise_level=(0, 30), brightness=(-20, 20), contrast=(0.8, 1.2),
+                 kernel_sizes=(1, 3, 5)):
+        self.noise_level = noise_level
+        self.brightness = brightness
+        self.contrast = contrast
+        self.kernel_sizes = np.asarray(kernel_sizes)
+        self.buffers = {}
+
+    def buffer(self, name, shape, dtype):
+        """ Return the buffer 'name', reallocated only if the shape changes """
+        if name not in self.buffers or self.buffers[name].shape != shape:
+            self.buffers[name] = np.empty(shape, dtype)
+        return self.buffers[name]
+
+    def sample_parameters(self, n, state=None):
+        """ Draw the parameters of n images from 'state', random_state by default
+        Returns a dict of (n,) arrays: 'noise_level', 'brightness', 'contrast'
+        and 'kernel_size', any of which can be set by hand before __call__ """
+        state = random_state if state is None else state
+        return {'noise_level': state.randint(self.noise_level[0], self.noise_level[1] + 1, size=n),
+                'brightness': state.uniform(self.brightness[0], self.brightness[1], size=n),
+                'contrast': state.uniform(self.contrast[0], self.contrast[1], size=n),
+                'kernel_size': self.kernel_sizes[state.randint(len(self.kernel_sizes), size=n)]}
+
+    @profiler.timed('augmentation')
+    def __call__(self, images, parameters=None, state=None):
+        """ Augment 'images' in place and return them
+        Parameters:
+          images: (N, H, W) uint8 C-contiguous stack
+          parameters: per-image parameters, see sample_parameters(), drawn by default
+          state: RandomState the parameters and the noise are drawn from,
+                 random_state by default
+        """
+        state = random_state if state is None else state
+        n = len(images)
+        if parameters is None:
+            parameters = self.sample_parameters(n, state)
+        # salt and pepper
+        noise = self.buffer('noise', images.shape, np.uint8)
+        mask = self.buffer('mask', images.shape, bool)
+        cv.setRNGSeed(int(state.randint(2 ** 31)))
+        cv.randu(noise.reshape(-1, images.shape[-1]), 0, 256)
+        level = np.asarray(parameters['noise_level'], np.int16).reshape(-1, 1, 1)
+        np.less(noise, level, out=mask)
+        np.copyto(images, 0, where=mask)
+        np.greater_equal(noise, 256 - level, out=mask)
+        np.copyto(images, 255, where=mask)
+        noisy = np.flatnonzero(parameters['noise_level'])
+        for i in noisy:
+            cv.blur(images[i], (5, 5), images[i])
+        # brightness and contrast around the mean of each image
+        jitter = self.buffer('jitter', images.shape, np.float32)
+        np.copyto(jitter, images)
+        mean = jitter.mean(axis=(1, 2), keepdims=True)
+        contrast = np.asarray(parameters['contrast'], np.float32).reshape(-1, 1, 1)
+        brightness = np.asarray(parameters['brightness'], np.float32).reshape(-1, 1, 1)
+        jitter -= mean
+        jitter *= contrast
+        jitter += mean + brightness
+        np.clip(jitter, 0, 255, out=jitter)
+        np.rint(jitter, out=jitter)
+        np.copyto(images, jitter, casting='unsafe')
+        # Gaussian blur with the kernel size of each image
+        for i in np.flatnonzero(np.asarray(parameters['kernel_size']) > 1):
+            k = int(parameters['kernel_size'][i])
+            cv.GaussianBlur(images[i], (k, k), 0, images[i])
+        return images
+
+
 def ccw(A, B, C, dim):
     """ Check if the points are listed in counter-clockwise order """
     if dim == 2:  # only 2 dimensions
@@ -265,6 +651,227 @@ def cal_trans_point(M, point):
     return np.array([[x, y]])
 
 
+@profiler.timed('template_warp')
+def transform_points(M, points, size):
+    """ Apply the 3x3 transformation M, affine or perspective, to (N, 2)
+    points in one product
+    Returns the rounded (N, 2) transformed points and the (N,) mask of
+    those inside the image of size 'size' """
+    points = np.asarray(points).reshape(-1, 2)
+    if np.array_equal(M[2], [0, 0, 1]):
+        new_points = np.rint(points @ M[:2, :2].T + M[:2, 2]).astype(int)
+    else:
+        projected = points @ M[:, :2].T + M[:, 2]
+        new_points = np.rint(projected[:, :2] / projected[:, 2:]).astype(int)
+    inside = (new_points[:, 0] >= 0) & (new_points[:, 0] < size[1]) & \
+             (new_points[:, 1] >= 0) & (new_points[:, 1] < size[0])
+    return new_points, inside
+
+
+def pyramid_size(size, level):
+    """ Size of the level 'level' of the pyramid of an image of size 'size',
+    each level being half the size of the previous one, rounded up as cv.pyrDown does """
+    h, w = size[:2]
+    for _ in range(level):
+        h, w = (h + 1) // 2, (w + 1) // 2
+    return h, w
+
+
+def build_pyramid(img, levels):
+    """ Return the list of the 'levels' levels of the pyramid of img, the
+    first one being img itself, built with a single cv.pyrDown chain """
+    pyramid = [img]
+    for _ in range(levels - 1):
+        pyramid.append(cv.pyrDown(pyramid[-1]))
+    return pyramid
+
+
+def scale_transform(M, level):
+    """ Express the 3x3 transformation M in the coordinates of a pyramid
+    level, where the coordinates are divided by 2 ** level: S M S^-1 """
+    scale = np.array([0.5 ** level, 0.5 ** level, 1.])
+    return M * scale[:, None] / scale[None, :]
+
+
+class ShapeGroundTruth():
+    """ Vector description of the shapes drawn by a generator. The keypoints
+    and the masks are derived from it, the masks being rasterized on demand.
+    The template holds all the lines, or the first polygon, contour or ellipse.
+    Parameters:
+      kind: name of the generator
+      image_size: (H, W) of the image
+      transform: 3x3 transformation from the image to the template, the
+                 inverse of the 'M' returned with full_output, identity
+                 when there is no template
+      lines: (K, 4) integer endpoints x1, y1, x2, y2
+      polygons: list of (N, 2) integer vertices
+      control_points: (S, 4, 2) cubic Bezier control points of a closed contour
+      ellipses: (K, 5) center x, y, half axes a, b and angle in degrees
+    """
+
+    def __init__(self, kind, image_size, transform=None, lines=None, polygons=None,
+                 control_points=None, ellipses=None):
+        self.kind = kind
+        self.image_size = tuple(image_size)
+        self.transform = np.eye(3) if transform is None else np.asarray(transform, dtype=float)
+        self.lines = None if lines is None else np.asarray(lines, dtype=int).reshape(-1, 4)
+        self.polygons = None if polygons is None else [np.asarray(p, dtype=int).reshape(-1, 2)
+                                                       for p in polygons]
+        self.control_points = (None if control_points is None
+                               else np.asarray(control_points, dtype=float).reshape(-1, 4, 2))
+        self.ellipses = None if ellipses is None else np.asarray(ellipses, dtype=float).reshape(-1, 5)
+        self.masks = {}
+
+    @property
+    def M(self):
+        """ Transformation from the template to the image """
+        return np.linalg.inv(self.transform)
+
+    def curve(self):
+        """ Integer points of the contour, as they are filled """
+        return bezier_batch(self.control_points).reshape(-1, 2).astype(int)
+
+    def points(self):
+        """ Keypoints of the image: the line endpoints, the polygon vertices,
+        the contour points or the ellipse center, none for multiple_polygons """
+        if self.kind == 'lines':
+            return self.lines.reshape(-1, 2)
+        if self.kind == 'contours':
+            return self.curve()
+        if self.kind == 'ellipses':
+            return self.ellipses[:1, :2].astype(int)
+        if self.kind == 'multiple_polygons':
+            return np.empty((0, 2), dtype=int)
+        return self.polygons[0]
+
+    def template_points(self):
+        return transform_points(self.transform, self.points(), self.image_size)[0]
+
+    def is_affine(self):
+        return np.array_equal(self.transform[2], [0, 0, 1])
+
+    def template_shapes(self):
+        """ Return the ground truth of the shapes of the template only, in the image """
+        return ShapeGroundTruth(self.kind, self.image_size, self.transform, lines=self.lines,
+                                polygons=None if self.polygons is None else self.polygons[:1],
+                                control_points=self.control_points,
+                                ellipses=None if self.ellipses is None else self.ellipses[:1])
+
+    def rasterize(self, frame='template', out=None, method='vector', level=0):
+        """ Draw the shapes in white on black
+        Parameters:
+          frame: 'image' for all the shapes of the image, 'template' for the
+                 shapes of the template, warped by the transform, black for
+                 multiple_polygons, which has no template
+          out: preallocated uint8 buffer of the size of the level
+          method: how the template is warped, 'vector' transforms the vertices
+                  and rasterizes them, as the generators do, 'warp' rasterizes
+                  the shapes in the image and resamples the mask with a single
+                  warpAffine or warpPerspective. The nearest neighbour
+                  resampling moves the edges of the filled shapes by about a
+                  pixel and breaks 1 pixel wide lines apart, so the lines
+                  always take the 'vector' path.
+          level: pyramid level, see build_pyramid(), the shapes are drawn with
+                 their coordinates divided by 2 ** level at sub-pixel precision
+        """
+        size = pyramid_size(self.image_size, level)
+        mask = np.zeros(size, np.uint8) if out is None else out
+        to_template = frame == 'template'
+        if to_template and self.kind == 'multiple_polygons':
+            mask[...] = 0
+            return mask
+        if to_template and method == 'warp' and self.kind != 'lines':
+            source = self.template_shapes().rasterize('image', level=level)
+            transform = scale_transform(self.transform, level)
+            with profiler.stage('template_warp'):
+                if self.is_affine():
+                    cv.warpAffine(source, transform[:2], size[::-1], dst=mask, flags=cv.INTER_NEAREST)
+                else:
+                    cv.warpPerspective(source, transform, size[::-1], dst=mask, flags=cv.INTER_NEAREST)
+            return mask
+        mask[...] = 0
+        return self.draw(mask, 255, frame, level)
+
+    def draw(self, img, color=255, frame='image', level=0):
+        """ Draw the shapes into img with 'color', over its content, without
+        a template warp, see rasterize() for the parameters """
+        to_template = frame == 'template'
+        if to_template and self.kind == 'multiple_polygons':  # no template
+            return img
+        # the integer coordinates are drawn as fixed point numbers with 'level' fractional bits
+        with profiler.stage('rasterization'):
+            if self.kind == 'lines':
+                lines = self.lines
+                if to_template:
+                    lines = transform_points(self.transform, lines, self.image_size)[0].reshape(-1, 4)
+                for x1, y1, x2, y2 in lines:
+                    cv.line(img, (int(x1), int(y1)), (int(x2), int(y2)), color, 1, cv.LINE_8, level)
+            elif self.kind == 'ellipses' and to_template and not self.is_affine():
+                # the perspective image of an ellipse is not an ellipse, fill its warped outline
+                x, y, ax, ay, angle = self.ellipses[0]
+                outline = cv.ellipse2Poly((int(x), int(y)), (int(ax), int(ay)), int(round(angle)),
+                                          0, 360, 1)
+                outline = transform_points(self.transform, outline, self.image_size)[0]
+                cv.fillPoly(img, [outline.reshape(-1, 1, 2)], color, cv.LINE_8, level)
+            elif self.kind == 'ellipses':
+                ellipses = self.ellipses
+                if to_template:
+                    center = transform_points(self.transform, ellipses[:1, :2], self.image_size)[0]
+                    rotation = math.degrees(math.atan2(self.transform[0, 1], self.transform[0, 0]))
+                    ellipses = np.concatenate([center, ellipses[:1, 2:4],
+                                               ellipses[:1, 4:] - rotation], axis=1)
+                for x, y, ax, ay, angle in ellipses:
+                    cv.ellipse(img, (int(x), int(y)), (int(ax), int(ay)), angle, 0, 360, color, -1,
+                               cv.LINE_8, level)
+            else:
+                if self.kind == 'contours':
+                    polygons = [self.curve()]
+                else:
+                    polygons = self.polygons[:1] if to_template else self.polygons
+                for polygon in polygons:
+                    if to_template:
+                        polygon = transform_points(self.transform, polygon, self.image_size)[0]
+                    cv.fillPoly(img, [polygon.reshape(-1, 1, 2)], color, cv.LINE_8, level)
+        return img
+
+    def mask(self, frame='template'):
+        """ Return the mask of rasterize(), computed once """
+        if frame not in self.masks:
+            self.masks[frame] = self.rasterize(frame)
+        return self.masks[frame]
+
+    def to_dict(self):
+        """ Return the parameters as plain lists, to be stored as JSON """
+        data = {'kind': self.kind, 'image_size': list(self.image_size),
+                'transform': self.transform.tolist()}
+        for name in ('lines', 'control_points', 'ellipses'):
+            if getattr(self, name) is not None:
+                data[name] = getattr(self, name).tolist()
+        if self.polygons is not None:
+            data['polygons'] = [polygon.tolist() for polygon in self.polygons]
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+def add_perspective(M, size, perspective=0.):
+    """ Compose the 3x3 transformation M with a random perspective distortion
+    centered on the image of size 'size'
+    Parameters:
+      perspective: relative change of scale from the center to the borders
+                   of the image, 0 keeps M affine and draws no random number
+    """
+    if not perspective:
+        return M
+    h, w = size
+    center = np.array([[1, 0, w / 2], [0, 1, h / 2], [0, 0, 1.]])
+    tilt = np.eye(3)
+    tilt[2, :2] = random_state.uniform(-perspective, perspective, size=2) / [w / 2, h / 2]
+    return center @ tilt @ np.linalg.inv(center) @ M
+
+
 def check_both_out_of_image(p1, p2, h, w):
     flag1, flag2 = True, True
     if p1[0][0] >= 0 and p1[0][0] < w and p1[0][1] >= 0 and p1[0][1] < h:
@@ -281,19 +888,20 @@ def check_out_image(p1, h, w):
     return flag1
 
 
-def draw_lines(img, nb_lines=10):
+@profiler.timed('draw_lines')
+def draw_lines(img, nb_lines=10, template_img=None, ground_truth=False, perspective=0.):
     """ Draw random lines and output the positions of the endpoints
     Parameters:
       nb_lines: maximal number of lines
+      template_img: preallocated (H, W) uint8 buffer for the template
+      ground_truth: return a ShapeGroundTruth, or None on failure, instead of
+                    (points, template_points, template_img, inv(M)), the
+                    template being rasterized on demand
+      perspective: strength of the perspective distortion of the template,
+                   see add_perspective(), 0 for a rotation and a translation
     """
     num_lines = random_state.randint(1, nb_lines)
-    segments = np.empty((0, 4), dtype=np.int)
-    points = np.empty((0, 2), dtype=np.int)
-    template_points = np.empty((0, 2), dtype=np.int)
     background_color = int(np.mean(img))
-    min_dim = min(img.shape)
-    ## template
-    template_img = np.zeros_like(img)
     # generate a random transfmation matrix
     h, w = img.shape[:2]
     center = (w / 2, h / 2)
@@ -305,72 +913,90 @@ def draw_lines(img, nb_lines=10):
     M = np.r_[M, [row_add]]
     M[0, 2] += translate[0]
     M[1, 2] += translate[1]
-
+    M = add_perspective(M, (h, w), perspective)
+
+    # Sample and transform all the lines at once
+    lines = np.stack([random_state.randint(w, size=num_lines), random_state.randint(h, size=num_lines),
+                      random_state.randint(w, size=num_lines), random_state.randint(h, size=num_lines)],
+                     axis=1)
+    template_lines, inside = transform_points(M, lines, (h, w))
+    template_lines = template_lines.reshape(-1, 4)
+    both_out = ~np.any(inside.reshape(-1, 2), axis=1)
+
+    kept = []
+    segments = SegmentSet(num_lines)
     for i in range(num_lines):
-        x1 = random_state.randint(img.shape[1])
-        y1 = random_state.randint(img.shape[0])
-        p1 = np.array([[x1, y1]])
-        x2 = random_state.randint(img.shape[1])
-        y2 = random_state.randint(img.shape[0])
-        p2 = np.array([[x2, y2]])
         # Check that there is no overlap
-        if intersect(segments[:, 0:2], segments[:, 2:4], p1, p2, 2):
+        with profiler.stage('rejection'):
+            overlaps = segments.intersects(lines[i])
+        if overlaps:
+            profiler.count('draw_lines.rejected_overlap')
             continue
-        p1_new = cal_trans_point(M, p1)
-        p2_new = cal_trans_point(M, p2)
-
-        if check_both_out_of_image(p1_new, p2_new, h, w):
-            return None, None, None, None
+        if both_out[i]:
+            profiler.count('draw_lines.failed')
+            return None if ground_truth else (None, None, None, None)
+        segments.add(lines[i])
+        kept.append(i)
+
+    with profiler.stage('rasterization'):
+        for x1, y1, x2, y2 in lines[kept]:
+            col = get_random_color(background_color)
+            thickness = random_state.randint(1, 2)
+            cv.line(img, (int(x1), int(y1)), (int(x2), int(y2)), col, thickness)
+    truth = ShapeGroundTruth('lines', (h, w), M, lines=lines[kept])
+    if ground_truth:
+        return truth
 
-        segments = np.concatenate([segments, np.array([[x1, y1, x2, y2]])], axis=0)
-        col = get_random_color(background_color)
-        thickness = random_state.randint(1, 2)
-        cv.line(img, (x1, y1), (x2, y2), col, thickness)
-        cv.line(template_img, (p1_new[0][0], p1_new[0][1]), (p2_new[0][0], p2_new[0][1]), 255, 1)
-        points = np.concatenate([points, np.array([[x1, y1], [x2, y2]])], axis=0)
-        template_points = np.concatenate(
-            [template_points, np.array([[p1_new[0][0], p1_new[0][1]], [p2_new[0][0], p2_new[0][1]]])], axis=0)
+    ## template
+    template_img = truth.rasterize('template', black_frame(img, template_img))
+    points = lines[kept].reshape(-1, 2)
+    template_points = template_lines[kept].reshape(-1, 2)
     return points, template_points, template_img, np.linalg.inv(M)
 
 
-def draw_polygon(img, max_sides=15):
+@profiler.timed('draw_polygon')
+def draw_polygon(img, max_sides=15, full_output=False, batch_size=8, max_tries=10,
+                 template_img=None, ground_truth=False, perspective=0.):
     """ Draw a polygon with a random number of corners
     and return the corner points
     Parameters:
       max_sides: maximal number of sides + 1
+      full_output: return (points, template_points, template_img, inv(M))
+                   as draw_lines does instead of template_img only
+      batch_size: number of candidate polygons sampled at once
+      max_tries: maximal number of batches before giving up
+      template_img: preallocated (H, W) uint8 buffer for the template
+      ground_truth: return a ShapeGroundTruth, or None on failure, the
+                    template being rasterized on demand
+      perspective: strength of the perspective distortion of the template,
+                   see add_perspective(), 0 for a rotation and a translation
     """
     # num_corners = random_state.randint(3, max_sides)
     num_corners = max_sides
     min_dim = min(img.shape[0], img.shape[1])
-    rad = max(random_state.rand() * min_dim / 2, min_dim / 3)
-    x = random_state.randint(rad, img.shape[1] - rad)  # Center of a circle
-    y = random_state.randint(rad, img.shape[0] - rad)
-
-    # Sample num_corners points inside the circle
-    slices = np.linspace(0, 2 * math.pi, num_corners + 1)
-    angles = [slices[i] + random_state.rand() * (slices[i + 1] - slices[i])
-              for i in range(num_corners)]
-    points = np.array([[int(x + (random_state.rand() * 0.5 + 0.5) * rad * math.cos(a)),
-                        int(y + (random_state.rand() * 0.5 + 0.5) * rad * math.sin(a))]
-                       for a in angles])
-
-    # Filter the points that are too close or that have an angle too flat
-    norms = [np.linalg.norm(points[(i - 1) % num_corners, :]
-                            - points[i, :]) for i in range(num_corners)]
-    mask = np.array(norms) > 0.01
-    points = points[mask, :]
-    num_corners = points.shape[0]
-    corner_angles = [angle_between_vectors(points[(i - 1) % num_corners, :] -
-                                           points[i, :],
-                                           points[(i + 1) % num_corners, :] -
-                                           points[i, :])
-                     for i in range(num_corners)]
-    mask = np.array(corner_angles) < (2 * math.pi / 3)
-    points = points[mask, :]
+    for _ in range(max_tries):
+        rads = np.maximum(random_state.rand(batch_size) * min_dim / 2, min_dim / 3)
+        centers = np.stack([random_state.randint(rads, img.shape[1] - rads),  # Center of a circle
+                            random_state.randint(rads, img.shape[0] - rads)], axis=1)
+
+        # Sample num_corners points inside the circle and filter the points
+        # that are too close or that have an angle too flat
+        candidates, valid = sample_polygons(centers, rads, np.full(batch_size, num_corners))
+        keep = filter_corners(candidates, valid)
+        enough = np.sum(keep, axis=1) >= 3
+        sampling_stats.record('draw_polygon', batch_size, np.sum(enough))
+        if np.any(enough):
+            break
+    else:  # not enough corners
+        sampling_stats.record_failure('draw_polygon')
+        profiler.count('draw_polygon.failed')
+        return None if ground_truth else (None, None, None, None)
+    i = np.argmax(enough)
+    x, y = int(centers[i, 0]), int(centers[i, 1])
+    points = candidates[i][keep[i]]
     num_corners = points.shape[0]
 
     ## template
-    template_img = np.zeros_like(img, np.uint8)
     # generate a random transfmation matrix
     h, w = img.shape[:2]
     center = (x, y)
@@ -382,48 +1008,63 @@ def draw_polygon(img, max_sides=15):
     M = np.r_[M, [row_add]]
     M[0, 2] += translate[0]
     M[1, 2] += translate[1]
+    M = add_perspective(M, (h, w), perspective)
     ## template
 
-    if num_corners < 3:  # not enough corners
-        return draw_polygon(img, max_sides)
+    ## template
+    corners_template, inside = transform_points(M, points, (h, w))
+    if not np.all(inside):
+        profiler.count('draw_polygon.failed')
+        return None if ground_truth else (None, None, None, None)
 
     corners = points.reshape((-1, 1, 2))
     col = get_random_color(int(np.mean(img)))
-    cv.fillPoly(img, [corners], col)
-
-    ## template
-    corners_templete = []
-    for point in corners:
-        point_new = cal_trans_point(M, point)
-        if check_out_image(point_new, h, w):
-            return None, None, None, None
-        corners_templete.append(point_new)
-
-    cv.fillPoly(template_img, [np.array(corners_templete)], 255)
-
+    with profiler.stage('rasterization'):
+        cv.fillPoly(img, [corners], col)
+    truth = ShapeGroundTruth('polygon', (h, w), M, polygons=[points])
+    if ground_truth:
+        return truth
+    template_img = truth.rasterize('template', black_frame(img, template_img))
+
+    if full_output:
+        return points, corners_template, template_img, np.linalg.inv(M)
     return template_img
 
 
-def draw_contours(img, max_n=20):
+@profiler.timed('draw_contours')
+def draw_contours(img, max_n=20, full_output=False, template_img=None, ground_truth=False,
+                  perspective=0., rad=0.2, edgy=None, mindst=None):
     """ Draw a polygon with a random number of corners
     and return the corner points
     Parameters:
       max_sides: maximal number of sides + 1
+      full_output: return (points, template_points, template_img, inv(M))
+                   as draw_lines does instead of template_img only
+      template_img: preallocated (H, W) uint8 buffer for the template
+      ground_truth: return a ShapeGroundTruth holding the Bezier control
+                    points, or None on failure, the template being
+                    rasterized on demand
+      perspective: strength of the perspective distortion of the template,
+                   see add_perspective(), 0 for a rotation and a translation
+      rad: distance of the Bezier control points to the corners, relative to
+           the length of the segments
+      edgy: sharpness of the corners, 0 is smoothest, random by default
+      mindst: minimal distance between the random corners in the unit
+              square, 0.7 / max_n by default
     """
     num_corners = max_n
     # big
 
-    curves = Curves(n=num_corners)
+    curves = Curves(n=num_corners, rad=rad, edgy=edgy, mindst=mindst)
     boundary = 50
-    points = curves.get_point(min_x=boundary, max_x=img.shape[1] - boundary, min_y=boundary,
-                              max_y=img.shape[0] - boundary)
+    control_points = curves.get_control_points(min_x=boundary, max_x=img.shape[1] - boundary,
+                                               min_y=boundary, max_y=img.shape[0] - boundary)
+    points = bezier_batch(control_points).reshape(-1, 2)
 
     x, y = np.mean(points, axis=0)  # # Center of a conture
     corners = points.reshape(-1, 1, 2).astype(int)
-    cv.fillPoly(img, [corners], 255)
 
     ## template
-    template_img = np.zeros_like(img,np.uint8)
     # generate a random transfmation matrix
     h, w = img.shape[:2]
     center = (x, y)
@@ -435,17 +1076,22 @@ def draw_contours(img, max_n=20):
     M = np.r_[M, [row_add]]
     M[0, 2] += translate[0]
     M[1, 2] += translate[1]
+    M = add_perspective(M, (h, w), perspective)
     ## template
 
-    corners_templete = []
-
-    for point in corners:
-        point_new = cal_trans_point(M, point)
-        if check_out_image(point_new, h, w):
-            return None, None, None, None
-        corners_templete.append(point_new)
-
-    cv.fillPoly(template_img, [np.array(corners_templete)], 255)
+    corners_template, inside = transform_points(M, corners, (h, w))
+    if not np.all(inside):
+        profiler.count('draw_contours.failed')
+        return None if ground_truth else (None, None, None, None)
+
+    with profiler.stage('rasterization'):
+        cv.fillPoly(img, [corners], 255)
+    truth = ShapeGroundTruth('contours', (h, w), M, control_points=control_points)
+    if ground_truth:
+        return truth
+    template_img = truth.rasterize('template', black_frame(img, template_img))
+    if full_output:
+        return corners.reshape(-1, 2), corners_template, template_img, np.linalg.inv(M)
     return template_img
 
 
@@ -460,6 +1106,161 @@ def overlap(center, rad, centers, rads):
     return flag
 
 
+class SegmentSet():
+    """ Growing set of segments [x1, y1, x2, y2] whose bounding boxes and
+    line equations are computed once, when they are added, and reused by
+    every intersection test. The tests give the same answer as intersect().
+    Parameters:
+      capacity: initial number of segments the storage can hold
+    """
+
+    def __init__(self, capacity=64):
+        self.count = 0
+        # x1, y1, x2, y2, x_min, y_min, x_max, y_max, dx, dy, dx * y1 - dy * x1
+        self.data = np.empty((capacity, 11))
+
+    @property
+    def segments(self):
+        return self.data[:self.count, 0:4]
+
+    @property
+    def boxes(self):
+        return self.data[:self.count, 4:8]
+
+    def __len__(self):
+        return self.count
+
+    def add(self, segments):
+        """ Add (S, 4) segments and return their ids """
+        segments = np.asarray(segments, dtype=float).reshape(-1, 4)
+        if self.count + len(segments) > len(self.data):
+            data = np.empty((max(2 * len(self.data), self.count + len(segments)), 11))
+            data[:self.count] = self.data[:self.count]
+            self.data = data
+        new = self.data[self.count:self.count + len(segments)]
+        new[:, 0:4] = segments
+        new[:, 4:6] = np.minimum(segments[:, 0:2], segments[:, 2:4])
+        new[:, 6:8] = np.maximum(segments[:, 0:2], segments[:, 2:4])
+        new[:, 8:10] = segments[:, 2:4] - segments[:, 0:2]
+        new[:, 10] = new[:, 8] * segments[:, 1] - new[:, 9] * segments[:, 0]
+        ids = np.arange(self.count, self.count + len(segments))
+        self.count += len(segments)
+        return ids
+
+    def intersects(self, segments, ids=None):
+        """ Check if any of the (E, 4) segments intersects a segment of the
+        set, or only the segments 'ids'. The bounding boxes are compared
+        first, then the new segments are tested one at a time against the
+        segments whose box overlaps theirs, stopping at the first intersection. """
+        data = self.data[:self.count] if ids is None else self.data[ids]
+        if len(data) == 0:
+            return False
+        segments = np.asarray(segments, dtype=float).reshape(-1, 4)
+        low = np.minimum(segments[:, 0:2], segments[:, 2:4])
+        high = np.maximum(segments[:, 0:2], segments[:, 2:4])
+        overlap = ((data[:, None, 4] <= high[None, :, 0]) & (data[:, None, 6] >= low[None, :, 0]) &
+                   (data[:, None, 5] <= high[None, :, 1]) & (data[:, None, 7] >= low[None, :, 1]))
+        for e in np.flatnonzero(np.any(overlap, axis=0)):
+            near = data[overlap[:, e]]
+            x1, y1, x2, y2 = segments[e]
+            # side of the endpoints of the placed segments w.r.t. the new one
+            dx, dy = x2 - x1, y2 - y1
+            c = dx * y1 - dy * x1
+            side_1 = dx * near[:, 1] - dy * near[:, 0] > c
+            side_2 = dx * near[:, 3] - dy * near[:, 2] > c
+            # side of the endpoints of the new segment w.r.t. the placed ones
+            side_3 = near[:, 8] * y1 - near[:, 9] * x1 > near[:, 10]
+            side_4 = near[:, 8] * y2 - near[:, 9] * x2 > near[:, 10]
+            if np.any((side_1 != side_2) & (side_3 != side_4)):
+                return True
+        return False
+
+
+class OccupancyGrid():
+    """ Uniform grid over the image that buckets the shapes already placed
+    (polygon edges and bounding circles), so that the overlap tests of a
+    candidate shape only look at the shapes in the cells it covers
+    Parameters:
+      size: size of the image
+      cell_size: side of a cell in pixels, by default 1/16th of the largest side
+    """
+
+    def __init__(self, size, cell_size=None):
+        self.cell_size = cell_size or max(16, max(size[0], size[1]) // 16)
+        self.shape = (-(-size[0] // self.cell_size), -(-size[1] // self.cell_size))
+        self.segment_cells = {}
+        self.circle_cells = {}
+        self.segment_set = SegmentSet()
+        self.circles = np.empty((0, 3))  # x, y, rad
+
+    @property
+    def segments(self):
+        return self.segment_set.segments
+
+    def _cells(self, x_min, y_min, x_max, y_max):
+        c0 = min(max(int(x_min // self.cell_size), 0), self.shape[1] - 1)
+        c1 = min(max(int(x_max // self.cell_size), 0), self.shape[1] - 1)
+        r0 = min(max(int(y_min // self.cell_size), 0), self.shape[0] - 1)
+        r1 = min(max(int(y_max // self.cell_size), 0), self.shape[0] - 1)
+        return [(r, c) for r in range(r0, r1 + 1) for c in range(c0, c1 + 1)]
+
+    def _insert(self, cells, ids, boxes):
+        # the cell ranges of all the boxes at once, as _cells() computes them
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        last = [self.shape[1] - 1, self.shape[0] - 1]
+        first_cells = np.clip(boxes[:, :2] // self.cell_size, 0, last).astype(int).tolist()
+        last_cells = np.clip(boxes[:, 2:] // self.cell_size, 0, last).astype(int).tolist()
+        for i, (c0, r0), (c1, r1) in zip(ids, first_cells, last_cells):
+            for r in range(r0, r1 + 1):
+                for c in range(c0, c1 + 1):
+                    cells.setdefault((r, c), []).append(i)
+
+    def _query(self, cells, box):
+        ids = [i for cell in self._cells(*box) for i in cells.get(cell, ())]
+        return np.unique(np.array(ids, dtype=int))
+
+    def add_segments(self, segments):
+        """ Add (S, 4) segments [x1, y1, x2, y2] """
+        ids = self.segment_set.add(segments)
+        self._insert(self.segment_cells, ids, self.segment_set.boxes[ids])
+
+    def add_circle(self, center, rad):
+        x, y = center
+        self._insert(self.circle_cells, [len(self.circles)], [(x - rad, y - rad, x + rad, y + rad)])
+        self.circles = np.concatenate([self.circles, [[x, y, rad]]], axis=0)
+
+    def nearby_segments(self, x_min, y_min, x_max, y_max):
+        """ Return the (K, 4) segments whose cells overlap the box """
+        return self.segments[self._query(self.segment_cells, (x_min, y_min, x_max, y_max))]
+
+    def nearby_circles(self, x_min, y_min, x_max, y_max):
+        """ Return the (K, 3) circles [x, y, rad] whose cells overlap the box """
+        return self.circles[self._query(self.circle_cells, (x_min, y_min, x_max, y_max))]
+
+    def segments_intersect(self, segments):
+        """ Check if any of the (E, 4) segments intersects a placed segment """
+        segments = np.asarray(segments, dtype=float).reshape(-1, 4)
+        box = (np.min(segments[:, 0::2]), np.min(segments[:, 1::2]),
+               np.max(segments[:, 0::2]), np.max(segments[:, 1::2]))
+        ids = self._query(self.segment_cells, box)
+        return len(ids) > 0 and self.segment_set.intersects(segments, ids)
+
+    def circle_overlaps(self, center, rad):
+        """ Check if the circle (center, rad) contains or is contained in a
+        placed circle, as overlap() does """
+        x, y = center
+        near = self.nearby_circles(x - rad, y - rad, x + rad, y + rad)
+        dist = np.sqrt(np.sum((near[:, :2] - [x, y]) ** 2, axis=1))
+        return bool(np.any(dist + np.minimum(rad, near[:, 2]) < np.maximum(rad, near[:, 2])))
+
+    def circle_intersects(self, center, rad):
+        """ Check if the circle (center, rad) intersects a placed circle """
+        x, y = center
+        near = self.nearby_circles(x - rad, y - rad, x + rad, y + rad)
+        dist = np.sqrt(np.sum((near[:, :2] - [x, y]) ** 2, axis=1))
+        return bool(np.any(rad > dist - near[:, 2]))
+
+
 def angle_between_vectors(v1, v2):
     """ Compute the angle (in rad) between the two vectors v1 and v2. """
     v1_u = v1 / np.linalg.norm(v1)
@@ -467,103 +1268,140 @@ def angle_between_vectors(v1, v2):
     return np.arccos(np.clip(np.dot(v1_u, v2_u), -1.0, 1.0))
 
 
-def draw_multiple_polygons(img, max_sides=8, nb_polygons=30, **extra):
+@profiler.timed('sampling')
+def sample_polygons(centers, rads, num_corners, radial=lambda u: u * 0.5 + 0.5):
+    """ Sample K random polygons at once, the i-th corner of a polygon with
+    n corners being drawn in the angular slice [2 * pi * i / n, 2 * pi * (i + 1) / n)
+    Parameters:
+      centers: (K, 2) centers of the circles the polygons are inscribed in
+      rads: (K,) radii of the circles
+      num_corners: (K,) number of corners of each polygon
+      radial: maps uniform samples to the distance of the corners to the
+              center, relative to the radius (x and y are drawn separately)
+    Returns the (K, N, 2) integer corners, N = max(num_corners), and the
+    (K, N) mask of the corners that exist
+    """
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    rads = np.asarray(rads, dtype=float).reshape(-1)
+    num_corners = np.asarray(num_corners).reshape(-1)
+    k, n = len(num_corners), int(np.max(num_corners))
+    valid = np.arange(n)[None, :] < num_corners[:, None]
+    angles = 2 * math.pi * (np.arange(n)[None, :] + random_state.rand(k, n)) / num_corners[:, None]
+    dist = radial(random_state.rand(k, n, 2)) * rads[:, None, None]
+    points = centers[:, None, :] + dist * np.stack([np.cos(angles), np.sin(angles)], axis=2)
+    return points.astype(int), valid
+
+
+def filter_corners(points, valid, max_angle=2 * math.pi / 3):
+    """ Mask the corners of a batch of polygons that duplicate their previous
+    neighbour or whose angle is too flat, both tests being done in one pass
+    over the (K, N) batch
+    Parameters:
+      points: (K, N, 2) corners, as returned by sample_polygons
+      valid: (K, N) mask of the corners that exist, the valid corners of
+             each polygon come first
+      max_angle: corners with a larger angle are dropped
+    Returns the (K, N) mask of the corners to keep
+    """
+    counts = np.maximum(np.sum(valid, axis=1), 1)[:, None]
+    i = np.arange(points.shape[1])[None, :]
+    to_prev = np.take_along_axis(points, ((i - 1) % counts)[:, :, None], axis=1) - points
+    to_next = np.take_along_axis(points, ((i + 1) % counts)[:, :, None], axis=1) - points
+    norm_prev = np.sqrt(np.sum(to_prev ** 2, axis=2))
+    norm_next = np.sqrt(np.sum(to_next ** 2, axis=2))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cos = np.sum(to_prev * to_next, axis=2) / (norm_prev * norm_next)
+    # the angle of a corner next to a duplicate is nan and fails the test
+    angles = np.arccos(np.clip(cos, -1.0, 1.0))
+    return valid & (norm_prev > 0.01) & (angles < max_angle)
+
+
+@profiler.timed('draw_multiple_polygons')
+def draw_multiple_polygons(img, max_sides=8, nb_polygons=30, ground_truth=False, **extra):
     """ Draw multiple polygons with a random number of corners
     and return the corner points
     Parameters:
       max_sides: maximal number of sides + 1
       nb_polygons: maximal number of polygons
+      ground_truth: return a ShapeGroundTruth with the drawn polygons instead of img
     """
-    segments = np.empty((0, 4), dtype=np.uint8)
-    centers = []
-    rads = []
+    grid = OccupancyGrid(img.shape)
     points = np.empty((0, 2), dtype=np.uint8)
     background_color = int(np.mean(img))
+    # Sample all the candidate polygons at once
+    min_dim = min(img.shape[0], img.shape[1])
+    num_corners = random_state.randint(3, max_sides, size=nb_polygons)
+    rads = np.maximum(random_state.rand(nb_polygons) * min_dim / 2, min_dim / 10)
+    centers = np.stack([random_state.randint(rads, img.shape[1] - rads),
+                        random_state.randint(rads, img.shape[0] - rads)], axis=1)
+    candidates, valid = sample_polygons(centers, rads, num_corners,
+                                        radial=lambda u: np.maximum(u, 0.4))
+    # Filter the points that are too close or that have an angle too flat
+    keep = filter_corners(candidates, valid)
+    drawn = []
     for i in range(nb_polygons):
-        num_corners = random_state.randint(3, max_sides)
-        min_dim = min(img.shape[0], img.shape[1])
-        rad = max(random_state.rand() * min_dim / 2, min_dim / 10)
-        x = random_state.randint(rad, img.shape[1] - rad)  # Center of a circle
-        y = random_state.randint(rad, img.shape[0] - rad)
-
-        # Sample num_corners points inside the circle
-        slices = np.linspace(0, 2 * math.pi, num_corners + 1)
-        angles = [slices[i] + random_state.rand() * (slices[i + 1] - slices[i])
-                  for i in range(num_corners)]
-        new_points = [[int(x + max(random_state.rand(), 0.4) * rad * math.cos(a)),
-                       int(y + max(random_state.rand(), 0.4) * rad * math.sin(a))]
-                      for a in angles]
-        new_points = np.array(new_points)
-
-        # Filter the points that are too close or that have an angle too flat
-        norms = [np.linalg.norm(new_points[(i - 1) % num_corners, :]
-                                - new_points[i, :]) for i in range(num_corners)]
-        mask = np.array(norms) > 0.01
-        new_points = new_points[mask, :]
-        num_corners = new_points.shape[0]
-        corner_angles = [angle_between_vectors(new_points[(i - 1) % num_corners, :] -
-                                               new_points[i, :],
-                                               new_points[(i + 1) % num_corners, :] -
-                                               new_points[i, :])
-                         for i in range(num_corners)]
-        mask = np.array(corner_angles) < (2 * math.pi / 3)
-        new_points = new_points[mask, :]
-        num_corners = new_points.shape[0]
-        if num_corners < 3:  # not enough corners
+        (x, y), rad = centers[i], rads[i]
+        new_points = candidates[i][keep[i]]
+        if new_points.shape[0] < 3:  # not enough corners
+            profiler.count('draw_multiple_polygons.rejected_corners')
             continue
 
-        new_segments = np.zeros((1, 4, num_corners))
-        new_segments[:, 0, :] = [new_points[i][0] for i in range(num_corners)]
-        new_segments[:, 1, :] = [new_points[i][1] for i in range(num_corners)]
-        new_segments[:, 2, :] = [new_points[(i + 1) % num_corners][0]
-                                 for i in range(num_corners)]
-        new_segments[:, 3, :] = [new_points[(i + 1) % num_corners][1]
-                                 for i in range(num_corners)]
+        new_segments = np.concatenate([new_points, np.roll(new_points, -1, axis=0)], axis=1)
 
         # Check that the polygon will not overlap with pre-existing shapes
-        if intersect(segments[:, 0:2, None],
-                     segments[:, 2:4, None],
-                     new_segments[:, 0:2, :],
-                     new_segments[:, 2:4, :],
-                     3) or overlap(np.array([x, y]), rad, centers, rads):
+        with profiler.stage('rejection'):
+            overlaps = grid.segments_intersect(new_segments) or grid.circle_overlaps((x, y), rad)
+        if overlaps:
+            profiler.count('draw_multiple_polygons.rejected_overlap')
             continue
-        centers.append(np.array([x, y]))
-        rads.append(rad)
-        new_segments = np.reshape(np.swapaxes(new_segments, 0, 2), (-1, 4))
-        segments = np.concatenate([segments, new_segments], axis=0)
+        grid.add_circle((x, y), rad)
+        grid.add_segments(new_segments)
 
-        # Color the polygon with a custom background
+        # Color the polygon, the custom background being plain white
         corners = new_points.reshape((-1, 1, 2))
-        mask = np.zeros(img.shape, np.uint8)
-        custom_background = np.zeros(img.shape, np.uint8)+255
-        cv.fillPoly(mask, [corners], 255)
-        locs = np.where(mask != 0)
-        img[locs[0], locs[1]] = custom_background[locs[0], locs[1]]
+        with profiler.stage('rasterization'):
+            cv.fillPoly(img, [corners], 255)
+        drawn.append(new_points)
+    if ground_truth:
+        return ShapeGroundTruth('multiple_polygons', img.shape[:2], polygons=drawn)
     return img
 
 
-def draw_ellipses(img, nb_ellipses=40):
-    """ Draw several ellipses
+@profiler.timed('draw_ellipses')
+def draw_ellipses(img, nb_ellipses=40, full_output=False, template_img=None, ground_truth=False,
+                  perspective=0.):
+    """ Draw several ellipses, the template holds the first one
     Parameters:
       nb_ellipses: maximal number of ellipses
+      full_output: return (center, template_center, template_img, inv(M))
+                   as draw_lines does instead of template_img only
+      template_img: preallocated (H, W) uint8 buffer for the template
+      ground_truth: return a ShapeGroundTruth with the parameters of all the
+                    ellipses, or None on failure, the template being
+                    rasterized on demand
+      perspective: strength of the perspective distortion of the template,
+                   see add_perspective(), 0 for a rotation and a translation
     """
-    centers = np.empty((0, 2), dtype=np.uint8)
-    rads = np.empty((0, 1), dtype=np.uint8)
+    grid = OccupancyGrid(img.shape)
     min_dim = min(img.shape[0], img.shape[1]) / 2
     background_color = int(np.mean(img))
     ax_0, ay_0 = -100, -100
+    drawn = []
     for i in range(nb_ellipses):
         ax = int(max(random_state.rand() * min_dim, min_dim / 4))
         ay = int(max(random_state.rand() * min_dim, min_dim / 4))
         if max(ax, ay) / min(ax, ay) < 0.2:
+            profiler.count('draw_ellipses.rejected_shape')
             continue
 
         # control similar ellipses
         if (abs(ax - ax_0) / ax < 0.1 and abs(ay - ay_0) / ax < 0.1) or (
                 abs(ay - ax_0) / ax < 0.1 and abs(ax - ay_0) / ax < 0.1):
+            profiler.count('draw_ellipses.rejected_shape')
             continue
         if (abs(ax - ax_0) < 10 and abs(ay - ay_0) < 10) or (
                 abs(ay - ax_0) < 10 and abs(ax - ay_0) < 10):
+            profiler.count('draw_ellipses.rejected_shape')
             continue
 
         max_rad = max(ax, ay)
@@ -572,20 +1410,22 @@ def draw_ellipses(img, nb_ellipses=40):
         new_center = np.array([[x, y]])
 
         # Check that the ellipsis will not overlap with pre-existing shapes
-        diff = centers - new_center
-        if np.any(max_rad > (np.sqrt(np.sum(diff * diff, axis=1)) - rads)):
+        with profiler.stage('rejection'):
+            overlaps = grid.circle_intersects((x, y), max_rad)
+        if overlaps:
+            profiler.count('draw_ellipses.rejected_overlap')
             continue
-        centers = np.concatenate([centers, new_center], axis=0)
-        rads = np.concatenate([rads, np.array([[max_rad]])], axis=0)
+        grid.add_circle((x, y), max_rad)
 
         col = get_random_color(background_color)
         angle = random_state.rand() * 45
-        cv.ellipse(img, (x, y), (ax, ay), angle, 0, 360, col, -1)
+        with profiler.stage('rasterization'):
+            cv.ellipse(img, (x, y), (ax, ay), angle, 0, 360, col, -1)
+        drawn.append((x, y, ax, ay, angle))
         if ax_0 == -100:
             ax_0 = ax
             ay_0 = ay
             ## template
-            template_img = np.zeros_like(img,np.uint8)
             # generate a random transfmation matrix
             h, w = img.shape[:2]
             center = (x, y)
@@ -597,27 +1437,192 @@ def draw_ellipses(img, nb_ellipses=40):
             M = np.r_[M, [row_add]]
             M[0, 2] += translate[0]
             M[1, 2] += translate[1]
+            M = add_perspective(M, (h, w), perspective)
 
             ## template
-            template_center = cal_trans_point(M, new_center)
-            cv.ellipse(template_img, (template_center[0][0], template_center[0][1]), (ax, ay), angle - angle_M, 0, 360,
-                       255, -1)  # clock-wise
-
+            template_center = transform_points(M, new_center, (h, w))[0]
+            first_center = new_center
+
+    if not drawn:
+        profiler.count('draw_ellipses.failed')
+        return None if ground_truth else (None, None, None, None) if full_output else None
+    truth = ShapeGroundTruth('ellipses', img.shape[:2], M, ellipses=drawn)
+    if ground_truth:
+        return truth
+    # the template ellipse is rotated clock-wise by angle_M
+    template_img = truth.rasterize('template', black_frame(img, template_img))
+    if full_output:
+        return first_center, template_center, template_img, np.linalg.inv(M)
     return template_img
 
 
+SCENE_KINDS = ('lines', 'polygon', 'contours', 'ellipses')
+
+
+class Scene():
+    """ Shapes of several kinds laid out together in one image by
+    compose_scene(), each shape with its own template transform
+    Parameters:
+      image_size: (H, W) of the image
+      shapes: list of ShapeGroundTruth holding one shape each, of a kind in SCENE_KINDS
+      instances: (H, W) uint16 instance map, 0 on the background and i + 1
+                 on the pixels of shapes[i], rasterized on demand if None
+    """
+
+    def __init__(self, image_size, shapes, instances=None):
+        self.image_size = tuple(image_size)
+        self.shapes = shapes
+        self.instances = instances
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def kind_labels(self):
+        """ (N,) label of each shape, 1 + the position of its kind in SCENE_KINDS """
+        return np.array([SCENE_KINDS.index(shape.kind) + 1 for shape in self.shapes], np.uint8)
+
+    def instance_map(self, out=None):
+        """ Return the instance map, drawn from the shapes if it is not known yet """
+        if self.instances is None or out is not None:
+            instances = np.zeros(self.image_size, np.uint16) if out is None else out
+            instances[...] = 0
+            for i, shape in enumerate(self.shapes):
+                shape.draw(instances, i + 1)
+            self.instances = instances
+        return self.instances
 
+    def labels(self):
+        """ (H, W) uint8 map of the kind labels, 0 on the background """
+        return np.concatenate([[0], self.kind_labels()]).astype(np.uint8)[self.instance_map()]
 
+    def template(self, i, out=None, level=0):
+        """ Template of the shape i, see ShapeGroundTruth.rasterize() """
+        return self.shapes[i].rasterize('template', out, level=level)
 
+    def transforms(self):
+        """ (N, 3, 3) transformations from the template of each shape to the image """
+        return np.array([shape.M for shape in self.shapes]).reshape(-1, 3, 3)
 
-img = np.zeros((480, 640), np.uint8)
+    def to_dict(self):
+        return {'image_size': list(self.image_size), 'shapes': [shape.to_dict() for shape in self.shapes]}
 
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['image_size'], [ShapeGroundTruth.from_dict(shape) for shape in data['shapes']])
 
-# contures
-# img = draw_contours(img, 10)
-# img = draw_multiple_polygons(img)
-# img = draw_ellipses(img)
-img = draw_polygon(img,10)
-cv2.imshow('img', img)
-cv2.waitKey(2000)
 
+def scene_shape(kind, center, rad, max_sides=8, max_n=8):
+    """ Sample a shape of 'kind' inscribed in the circle (center, rad)
+    Returns the ShapeGroundTruth keyword arguments of the shape and its
+    (E, 4) outline segments, or None if no valid polygon was drawn
+    """
+    x, y = center
+    if kind == 'lines':
+        angle = random_state.rand() * math.pi
+        d = rad * np.array([math.cos(angle), math.sin(angle)])
+        line = np.concatenate([center - d, center + d]).astype(int)
+        return {'lines': [line]}, line[None, :]
+    if kind == 'polygon':
+        candidates, valid = sample_polygons([center], [rad], [random_state.randint(3, max_sides)],
+                                            radial=lambda u: np.maximum(u, 0.4))
+        outline = candidates[0][filter_corners(candidates, valid)[0]]
+        if len(outline) < 3:
+            return None
+        geometry = {'polygons': [outline]}
+    elif kind == 'contours':
+        curves = Curves(n=random_state.randint(3, max_n + 1))
+        control_points = curves.get_control_points(x - rad, x + rad, y - rad, y + rad)
+        outline = bezier_batch(control_points, num=16).reshape(-1, 2).astype(int)
+        geometry = {'control_points': control_points}
+    else:
+        ax, ay = (rad * random_state.uniform(0.4, 1, 2)).astype(int)
+        angle = random_state.rand() * 45
+        outline = cv.ellipse2Poly((int(x), int(y)), (int(ax), int(ay)), int(round(angle)), 0, 360, 5)
+        geometry = {'ellipses': [(int(x), int(y), ax, ay, angle)]}
+    return geometry, np.concatenate([outline, np.roll(outline, -1, axis=0)], axis=1)
+
+
+def scene_contains(instances, grid, outline, center, rad):
+    """ Check if a candidate whose outline crosses no placed outline lies
+    inside a placed shape, one of its outline points being drawn in the
+    instance map, or contains one, the center of a placed shape being inside
+    its outline """
+    h, w = instances.shape[:2]
+    if np.any(instances[np.clip(outline[:, 1], 0, h - 1), np.clip(outline[:, 0], 0, w - 1)]):
+        return True
+    if len(outline) < 3:  # a line contains nothing
+        return False
+    x, y = center
+    contour = outline.reshape(-1, 1, 2).astype(np.float32)
+    return any(cv.pointPolygonTest(contour, (float(cx), float(cy)), False) >= 0
+               for cx, cy, _ in grid.nearby_circles(x - rad, y - rad, x + rad, y + rad))
+
+
+@profiler.timed('compose_scene')
+def compose_scene(img, nb_shapes=None, max_sides=8, max_n=8, rad_range=(0.05, 0.2), perspective=0.,
+                  instances=None):
+    """ Lay out lines, polygons, Bezier contours and ellipses together in img
+    and return their Scene, or None if no shape could be placed. The
+    candidates of all the kinds are tested against one OccupancyGrid, as
+    draw_multiple_polygons does, and each placed shape is drawn into the
+    image and into the instance map right away, so the only full-frame
+    pass is the clearing of the instance map.
+    Parameters:
+      nb_shapes: maximal number of shapes of each kind, {kind: count}
+      max_sides: maximal number of sides + 1 of the polygons
+      max_n: maximal number of corners of the contours
+      rad_range: range of the radius of the circle a shape is inscribed in,
+                 relative to the smallest side of the image
+      perspective: strength of the perspective distortion of the templates,
+                   see add_perspective(), 0 for a rotation and a translation
+      instances: preallocated (H, W) uint16 buffer for the instance map
+    """
+    if nb_shapes is None:
+        nb_shapes = {'lines': 5, 'polygon': 5, 'contours': 3, 'ellipses': 5}
+    h, w = img.shape[:2]
+    min_dim = min(h, w)
+    grid = OccupancyGrid(img.shape)
+    background_color = int(np.mean(img))
+    instances = np.zeros((h, w), np.uint16) if instances is None else instances
+    instances[...] = 0
+    # the candidates of the different kinds are interleaved, so that none takes the room first
+    kinds = np.repeat(np.arange(len(SCENE_KINDS)), [nb_shapes.get(kind, 0) for kind in SCENE_KINDS])
+    kinds = kinds[random_state.permutation(len(kinds))]
+    shapes = []
+    for kind in (SCENE_KINDS[k] for k in kinds):
+        rad = random_state.uniform(*rad_range) * min_dim
+        center = np.array([random_state.uniform(rad, w - rad), random_state.uniform(rad, h - rad)])
+        candidate = scene_shape(kind, center, rad, max_sides, max_n)
+        if candidate is None:
+            profiler.count('compose_scene.rejected_corners')
+            continue
+        geometry, segments = candidate
+        outline = segments[:, :2]
+        rad = np.max(np.linalg.norm(outline - center, axis=1))  # tight bounding circle
+        with profiler.stage('rejection'):
+            overlaps = (grid.segments_intersect(segments) or grid.circle_overlaps(center, rad)
+                        or scene_contains(instances, grid, outline, center, rad))
+        if overlaps:
+            profiler.count('compose_scene.rejected_overlap')
+            continue
+
+        # template transformation, a rotation about the shape that moves it to the image center
+        M = cv2.getRotationMatrix2D((center[0], center[1]), random_state.randint(-45, 45), 1)
+        M = np.r_[M, [[0, 0, 1]]]
+        M[0, 2] += w / 2 - center[0]
+        M[1, 2] += h / 2 - center[1]
+        M = add_perspective(M, (h, w), perspective)
+        if not np.all(transform_points(M, segments[:, :2], (h, w))[1]):
+            profiler.count('compose_scene.rejected_template')
+            continue
+        grid.add_circle(center, rad)
+        grid.add_segments(segments)
+
+        truth = ShapeGroundTruth(kind, (h, w), M, **geometry)
+        truth.draw(img, get_random_color(background_color))
+        truth.draw(instances, len(shapes) + 1)
+        shapes.append(truth)
+    if not shapes:
+        profiler.count('compose_scene.failed')
+        return None
+    return Scene((h, w), shapes, instances)
@@ -0,0 +1,208 @@
+""" Command line entry point of the synthetic shape generators
+
+    python shape_cli.py demo --kind polygon --seed 3
+    python shape_cli.py demo --kind ellipses --background --output ellipses.png
+    python shape_cli.py demo --kind scene --background --output scene.png
+    python shape_cli.py generate data/shapes --kinds polygon ellipses --ratios 3 1 \
+        --count 1000000 --size 480x640 --seed 0
+    python shape_cli.py sweep --kind contours --param max_n=5,10,20 --param rad=0.1,0.2,0.4
+    python shape_cli.py sweep --kind polygon --param max_sides=4:15 --param min_rad_ratio=0.005:0.03 \
+        --random 20
+
+'generate' writes a sharded dataset (see shape_shards) with all the cores.
+Running the same command again after it was killed resumes it from its last
+completed shard. 'sweep' evaluates configurations of a generator in parallel
+and caches the results, see shape_sweep.
+
+The library modules only import numpy and OpenCV and never open a window,
+so they load quickly in the workers of a process pool and run headless. """
+import argparse
+
+import numpy as np
+
+GENERATOR_NAMES = ['lines', 'polygon', 'contours', 'multiple_polygons', 'ellipses']
+
+
+def parse_size(text):
+    h, w = text.lower().split('x')
+    return int(h), int(w)
+
+
+def parse_number(text):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def parse_parameter(text):
+    """ Parse name=v1,v2,... into (name, [values]) and name=low:high into (name, (low, high)) """
+    name, values = text.split('=')
+    if ':' in values:
+        low, high = values.split(':')
+        return name, (parse_number(low), parse_number(high))
+    return name, [parse_number(value) for value in values.split(',')]
+
+
+def demo(args):
+    """ Render one sample and show it next to its template, or save it with --output """
+    import cv2
+    import generate_dataset
+
+    if args.kind == 'scene':
+        sample = generate_dataset.generate_scene(args.index, args.seed, args.size,
+                                                 background=args.background)
+    else:
+        sample = generate_dataset.generate_sample(args.kind, args.index, args.seed, args.size,
+                                                  background=args.background)
+    if sample is None:
+        print('%s failed on sample %d of seed %d' % (args.kind, args.index, args.seed))
+        return 1
+    img = sample['image']
+    if args.kind == 'scene':  # the kind labels next to the image
+        labels = sample['scene'].labels() * np.uint8(255 // len(GENERATOR_NAMES))
+        img = np.hstack([img, np.full((img.shape[0], 4), 255, np.uint8), labels])
+    elif sample['template'] is not None:
+        img = np.hstack([img, np.full((img.shape[0], 4), 255, np.uint8), sample['template']])
+    if args.output:
+        cv2.imwrite(args.output, img)
+        print('saved %s' % args.output)
+        return 0
+    cv2.imshow(args.kind, img)
+    cv2.waitKey(args.wait)
+    cv2.destroyAllWindows()
+    return 0
+
+
+def generate(args):
+    """ Generate a sharded dataset, resuming it if it was interrupted """
+    import time
+    import generate_dataset
+
+    if args.ratios is not None and len(args.ratios) != len(args.kinds):
+        print('expected one ratio per kind, got %d ratios for %d kinds'
+              % (len(args.ratios), len(args.kinds)))
+        return 2
+    if len(args.kinds) == 1:
+        kind = args.kinds[0]
+    else:
+        kind = dict(zip(args.kinds, args.ratios or [1] * len(args.kinds)))
+    start = time.perf_counter()
+
+    def log(message):
+        print('%s, %.0f s' % (message, time.perf_counter() - start), flush=True)
+
+    kwargs = {'perspective': args.perspective} if args.perspective else {}
+    if args.pyramid_levels > 1:
+        kwargs['pyramid_levels'] = args.pyramid_levels
+    try:
+        index = generate_dataset.generate_shards(args.output, kind, args.count, args.seed, args.size,
+                                                 args.shard_size, args.workers, args.threads,
+                                                 background=not args.black,
+                                                 ground_truth=args.ground_truth, log=log, **kwargs)
+    except ValueError as e:
+        print(e)
+        return 2
+    except KeyboardInterrupt:
+        print('interrupted, run the same command again to resume from the last completed shard')
+        return 130
+    print('%s: %d samples in %d shards' % (args.output, index['num_samples'], len(index['shards'])))
+    return 0
+
+
+def sweep(args):
+    """ Evaluate parameter configurations of a generator, caching the results """
+    import shape_sweep
+
+    space = dict(args.param)
+    if args.random:
+        configurations = shape_sweep.random_configurations(space, args.random, args.seed)
+    elif any(isinstance(values, tuple) for values in space.values()):
+        print('ranges low:high need --random, lists v1,v2,... form a grid')
+        return 2
+    else:
+        configurations = shape_sweep.parameter_grid(space)
+    results = shape_sweep.run_sweep(args.kind, configurations, args.samples, args.seed, args.size,
+                                    args.workers, None if args.no_cache else args.cache,
+                                    args.refresh)
+    print(shape_sweep.format_table(results))
+    print()
+    print('Pareto front of throughput and failure rate:')
+    print(shape_sweep.format_table(shape_sweep.pareto_front(results)))
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Synthetic shape generators')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_demo = commands.add_parser('demo', help=demo.__doc__.strip())
+    parser_demo.add_argument('--kind', default='polygon', choices=GENERATOR_NAMES + ['scene'],
+                             help="'scene' composes all the kinds of shapes in one image")
+    parser_demo.add_argument('--size', type=parse_size, default=(480, 640), metavar='HxW')
+    parser_demo.add_argument('--seed', type=int, default=0)
+    parser_demo.add_argument('--index', type=int, default=0, help='sample index within the seed')
+    parser_demo.add_argument('--background', action='store_true',
+                             help='draw on a random background instead of a black image')
+    parser_demo.add_argument('--output', help='save the image instead of showing it')
+    parser_demo.add_argument('--wait', type=int, default=2000,
+                             help='milliseconds the window stays open, 0 waits for a key')
+    parser_demo.set_defaults(run=demo)
+
+    parser_generate = commands.add_parser('generate', help=generate.__doc__.strip())
+    parser_generate.add_argument('output', help='directory of the dataset')
+    parser_generate.add_argument('--kinds', nargs='+', default=['polygon'], choices=GENERATOR_NAMES)
+    parser_generate.add_argument('--ratios', nargs='+', type=float,
+                                 help='relative frequency of each kind, equal by default')
+    parser_generate.add_argument('--count', type=int, required=True, help='number of samples')
+    parser_generate.add_argument('--size', type=parse_size, default=(480, 640), metavar='HxW')
+    parser_generate.add_argument('--seed', type=int, default=0)
+    parser_generate.add_argument('--shard-size', type=int, default=1024,
+                                 help='samples per shard, the unit of resumption')
+    parser_generate.add_argument('--workers', type=int, default=None,
+                                 help='number of processes, all the cores by default')
+    parser_generate.add_argument('--threads', type=int, default=None,
+                                 help='render with this many threads per stage in one process '
+                                      'instead of a process pool')
+    parser_generate.add_argument('--black', action='store_true',
+                                 help='draw on black images instead of random backgrounds')
+    parser_generate.add_argument('--ground-truth', action='store_true',
+                                 help='store the vector ground truth instead of the template images, '
+                                      'which are rasterized when read')
+    parser_generate.add_argument('--perspective', type=float, default=0.,
+                                 help='strength of the perspective distortion of the templates, '
+                                      '0 for rotations and translations only')
+    parser_generate.add_argument('--pyramid-levels', type=int, default=1,
+                                 help='also store the images and templates at this many '
+                                      'resolutions, each half the size of the previous one')
+    parser_generate.set_defaults(run=generate)
+
+    parser_sweep = commands.add_parser('sweep', help=sweep.__doc__.strip())
+    parser_sweep.add_argument('--kind', default='polygon', choices=GENERATOR_NAMES)
+    parser_sweep.add_argument('--param', type=parse_parameter, action='append', default=[],
+                              metavar='NAME=V1,V2|NAME=LOW:HIGH',
+                              help='values of a parameter of the generator or of the background')
+    parser_sweep.add_argument('--random', type=int, default=0,
+                              help='evaluate this many random configurations instead of the grid')
+    parser_sweep.add_argument('--samples', type=int, default=200,
+                              help='samples rendered per configuration')
+    parser_sweep.add_argument('--size', type=parse_size, default=(480, 640), metavar='HxW')
+    parser_sweep.add_argument('--seed', type=int, default=0)
+    parser_sweep.add_argument('--workers', type=int, default=None,
+                              help='number of processes, all the cores by default')
+    parser_sweep.add_argument('--cache', default='.sweep_cache',
+                              help='directory the results are memoized in')
+    parser_sweep.add_argument('--no-cache', action='store_true')
+    parser_sweep.add_argument('--refresh', action='store_true',
+                              help='evaluate the cached configurations again')
+    parser_sweep.set_defaults(run=sweep)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,211 @@
+""" Threaded staged generation of synthetic shape samples
+
+A sample goes through the stages background -> draw -> augment -> encode.
+Each stage runs in its own threads and passes the samples to the next one
+through a bounded queue, so the stages overlap and a slow stage holds the
+faster ones back instead of letting samples pile up. The OpenCV calls
+release the GIL, so threads of one process can keep many cores busy while
+sharing a single BackgroundBank, instead of one copy per worker process.
+
+Every sample carries its own RandomState from stage to stage, which the
+stage binds to its thread with set_random_state(): the samples are the same
+as those of generate_sample(), whatever the number of threads.
+
+    for sample in sample_pipeline('polygon', 1000, threads={'draw': 8}):
+        ...
+"""
+import os
+import queue
+import threading
+
+import cv2
+
+import generate_dataset
+import generate_shape_2d as shapes
+from shape_profiling import profiler
+
+STAGES = ('background', 'draw', 'augment', 'encode')
+DONE = object()
+
+
+class Pipeline():
+    """ Chain of functions run by threads connected by bounded queues, the
+    outputs being yielded in the order of the inputs
+    Parameters:
+      stages: list of (name, function, num_threads), function maps an item to
+              the item of the next stage, or to None to drop it
+      queue_size: capacity of each queue between two stages
+    """
+
+    def __init__(self, stages, queue_size=16):
+        self.stages = [(name, function, max(1, int(num_threads)))
+                       for name, function, num_threads in stages]
+        self.queue_size = queue_size
+
+    def run(self, items):
+        """ Feed 'items' to the first stage and yield the outputs of the last
+        one in order. An exception raised in a stage stops the pipeline and is
+        raised again here. """
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        stop = threading.Event()
+        errors = []
+
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return DONE
+
+        def fail(e):
+            errors.append(e)
+            stop.set()
+
+        def feed():
+            try:
+                for task in enumerate(items):
+                    if not put(queues[0], task):
+                        return
+            except BaseException as e:
+                fail(e)
+                return
+            for _ in range(self.stages[0][2]):
+                put(queues[0], DONE)
+
+        def work(k, name, function, running):
+            while True:
+                task = get(queues[k])
+                if task is DONE:
+                    break
+                seq, item = task
+                try:
+                    if item is None:  # dropped by a previous stage
+                        result = None
+                    else:
+                        with profiler.stage('pipeline.' + name):
+                            result = function(item)
+                except BaseException as e:
+                    fail(e)
+                    return
+                if not put(queues[k + 1], (seq, result)):
+                    return
+            with running['lock']:
+                running['count'] -= 1
+                last = running['count'] == 0
+            if last:  # the next stage starts its shutdown once every item went through
+                for _ in range(self.stages[k + 1][2] if k + 1 < len(self.stages) else 1):
+                    put(queues[k + 1], DONE)
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for k, (name, function, num_threads) in enumerate(self.stages):
+            running = {'lock': threading.Lock(), 'count': num_threads}
+            threads += [threading.Thread(target=work, args=(k, name, function, running), daemon=True)
+                        for _ in range(num_threads)]
+        for thread in threads:
+            thread.start()
+
+        pending = {}
+        next_seq = 0
+        try:
+            while True:
+                task = get(queues[-1])
+                if task is DONE:
+                    break
+                seq, result = task
+                pending[seq] = result
+                while next_seq in pending:
+                    result = pending.pop(next_seq)
+                    next_seq += 1
+                    if result is not None:
+                        yield result
+            if errors:
+                raise errors[0]
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+
+def noise_and_blur(sample):
+    """ Augmentation adding salt and pepper noise and a final blur to the image """
+    shapes.add_salt_and_pepper(sample['image'])
+    shapes.final_blur(sample['image'])
+    return sample
+
+
+def png_writer(directory):
+    """ Return an encode stage writing the image and the template of every
+    sample to directory/%08d_image.png and directory/%08d_template.png """
+    os.makedirs(directory, exist_ok=True)
+
+    def write(sample):
+        path = os.path.join(directory, '%08d' % sample['index'])
+        cv2.imwrite(path + '_image.png', sample['image'])
+        if sample['template'] is not None:
+            cv2.imwrite(path + '_template.png', sample['template'])
+        return sample
+    return write
+
+
+def sample_pipeline(kind, num_samples, base_seed=0, size=(480, 640), background=True,
+                    augment=None, encode=None, threads=None, queue_size=16, start=0,
+                    ground_truth=False, **kwargs):
+    """ Generate the samples start, ..., start + num_samples - 1 with a threaded
+    Pipeline and yield them in index order. Failed samples are skipped.
+    Parameters:
+      kind: name of the generator or {name: weight} mixture, see generate_dataset
+      num_samples: number of samples to render
+      base_seed: seed of the whole dataset
+      size: size of the images
+      background: as in generate_sample(), a callable can e.g. crop a shared BackgroundBank
+      augment: function modifying a sample in place, e.g. noise_and_blur,
+               called with the random state of the sample
+      encode: function called on every finished sample, e.g. png_writer()
+      threads: number of threads of every stage, or a dict of them per stage
+               name in STAGES, the missing ones getting one thread
+      queue_size: capacity of the queues between the stages
+      start: index of the first sample
+      ground_truth: keep the vector ShapeGroundTruth, see generate_sample()
+      kwargs: extra parameters of the generators
+    """
+    generate_dataset.check_kinds(kind)
+    if not isinstance(threads, dict):
+        threads = {stage: threads or 1 for stage in STAGES}
+
+    def draw_background(index):
+        name = kind
+        if isinstance(kind, dict):
+            name = generate_dataset.mixture_kind(kind, base_seed, index)
+        return generate_dataset.start_sample(name, index, base_seed, size, background)
+
+    def draw(task):
+        sample, state = task
+        sample = generate_dataset.finish_sample(sample, state, ground_truth=ground_truth, **kwargs)
+        return None if sample is None else (sample, state)
+
+    def augment_sample(task):
+        sample, state = task
+        shapes.set_random_state(state)
+        sample = augment(sample)
+        if sample['pyramid'] is not None:  # rebuilt from the augmented image
+            sample['pyramid']['images'] = shapes.build_pyramid(sample['image'],
+                                                               len(sample['pyramid']['images']))
+        return sample, state
+
+    stages = [('background', draw_background, threads.get('background', 1)),
+              ('draw', draw, threads.get('draw', 1))]
+    if augment is not None:
+        stages.append(('augment', augment_sample, threads.get('augment', 1)))
+    stages.append(('encode', lambda task: task[0] if encode is None else encode(task[0]),
+                   threads.get('encode', 1)))
+    return Pipeline(stages, queue_size).run(range(start, start + num_samples))
@@ -0,0 +1,152 @@
+""" Opt-in instrumentation of the synthetic shape generators
+
+The generators time their stages (background, sampling, rejection,
+rasterization, template_warp, blur, augmentation) and count their rejection
+loops and failures through the module-level 'profiler'. Timing is off by default and
+costs a function call per stage when disabled:
+
+    import shape_profiling
+    shape_profiling.enable_profiling()
+    ...  # generate samples
+    print(shape_profiling.profiler.table())
+    shape_profiling.profiler.to_json('profile.json')
+
+Stage times are inclusive: a stage nested in another one is also counted in
+the outer one. The statistics are kept per process. """
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class SamplingStats():
+    """ Acceptance statistics of the rejection samplers, per sampler name """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.candidates = {}
+        self.accepted = {}
+        self.failures = {}
+
+    def record(self, name, candidates, accepted):
+        """ Count 'candidates' tested candidates, 'accepted' of which were valid """
+        with self.lock:
+            self.candidates[name] = self.candidates.get(name, 0) + int(candidates)
+            self.accepted[name] = self.accepted.get(name, 0) + int(accepted)
+
+    def record_failure(self, name):
+        """ Count a call that ran out of tries """
+        with self.lock:
+            self.failures[name] = self.failures.get(name, 0) + 1
+
+    def acceptance_rate(self, name):
+        return self.accepted.get(name, 0) / max(self.candidates.get(name, 0), 1)
+
+    def summary(self):
+        return {name: {'candidates': self.candidates[name],
+                       'accepted': self.accepted[name],
+                       'acceptance_rate': self.acceptance_rate(name),
+                       'failures': self.failures.get(name, 0)}
+                for name in sorted(self.candidates)}
+
+
+sampling_stats = SamplingStats()
+
+
+class Profiler():
+    """ Wall time per stage and event counters """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.calls = {}
+        self.total = {}
+        self.longest = {}
+        self.counts = {}
+
+    def stage(self, name):
+        """ Context manager timing a stage, a no-op when disabled """
+        if not self.enabled:
+            return nullcontext()
+        return self._timed(name)
+
+    def timed(self, name):
+        """ Decorator timing every call of a function as the stage 'name' """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with self._timed(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.calls[name] = self.calls.get(name, 0) + 1
+                self.total[name] = self.total.get(name, 0.) + elapsed
+                self.longest[name] = max(self.longest.get(name, 0.), elapsed)
+
+    def count(self, name, n=1):
+        """ Count n events, e.g. rejected candidates or failed samples """
+        if self.enabled:
+            with self.lock:
+                self.counts[name] = self.counts.get(name, 0) + n
+
+    def summary(self):
+        """ Return the stage timings, the counters and the sampler statistics """
+        stages = {name: {'calls': self.calls[name],
+                         'total_s': self.total[name],
+                         'mean_ms': 1000 * self.total[name] / self.calls[name],
+                         'max_ms': 1000 * self.longest[name]}
+                  for name in sorted(self.calls)}
+        return {'stages': stages, 'counts': dict(sorted(self.counts.items())),
+                'sampling': sampling_stats.summary()}
+
+    def table(self):
+        """ Return the summary as a plain text table """
+        summary = self.summary()
+        lines = ['%-24s %10s %10s %10s %10s' % ('stage', 'calls', 'total s', 'mean ms', 'max ms')]
+        for name, stage in summary['stages'].items():
+            lines.append('%-24s %10d %10.3f %10.3f %10.3f'
+                         % (name, stage['calls'], stage['total_s'], stage['mean_ms'], stage['max_ms']))
+        lines.append('')
+        lines.append('%-40s %10s' % ('counter', 'count'))
+        for name, count in summary['counts'].items():
+            lines.append('%-40s %10d' % (name, count))
+        lines.append('')
+        lines.append('%-24s %10s %10s %10s %10s' % ('sampler', 'candidates', 'accepted', 'rate', 'failures'))
+        for name, stats in summary['sampling'].items():
+            lines.append('%-24s %10d %10d %10.3f %10d'
+                         % (name, stats['candidates'], stats['accepted'],
+                            stats['acceptance_rate'], stats['failures']))
+        return '\n'.join(lines)
+
+    def to_json(self, path=None):
+        """ Return the summary as JSON, and write it to 'path' if given """
+        text = json.dumps(self.summary(), indent=1)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+
+profiler = Profiler()
+
+
+def enable_profiling(enabled=True):
+    profiler.enabled = enabled
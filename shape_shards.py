@@ -0,0 +1,510 @@
+""" Sharded on-disk storage of synthetic shape samples
+
+A dataset is a directory holding an index.json and one sub-directory per
+shard. Each shard stores its fields as raw .npy arrays that can be
+memory-mapped:
+  images.npy, templates.npy: (n, H, W) uint8
+  transforms.npy: (n, 3, 3) float64, the inverse transform M of each sample
+  points.npy, template_points.npy: (k, 2) int32, the keypoints of all the samples
+  point_offsets.npy: (n + 1,) int64, the keypoints of sample i are
+                     points[point_offsets[i]:point_offsets[i + 1]]
+  indices.npy: (n,) int64, index of the sample in the generation run
+  kinds.npy: (n,) uint8, position of the generator name in index.json 'kinds'
+  ground_truth.json: list of the ShapeGroundTruth.to_dict() of the samples
+                     generated with ground_truth=True, null for the others.
+                     Only written if there is at least one.
+A shard written with store_templates=False has no templates.npy, its
+templates are rasterized from ground_truth.json when they are read.
+A dataset written with pyramid_levels=L > 1 also stores, for each level
+l = 1, ..., L - 1, the images and templates divided in size by 2 ** l:
+  images_<l>.npy, templates_<l>.npy: (n, H_l, W_l) uint8
+The transforms and keypoints are only stored for the full resolution, those
+of a level are derived from them, see ShardReader.level().
+Samples without a template (multiple_polygons) get a black template and an
+identity transform.
+
+ShardWriter streams generated samples into this layout, or appends to an
+interrupted one, and ShardReader memory-maps it back. """
+import io
+import json
+import mmap
+import os
+import queue
+import shutil
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+INDEX_FILE = 'index.json'
+
+
+def shard_name(shard_id):
+    return 'shard-%05d' % shard_id
+
+
+def write_index(root, index):
+    """ Atomically replace the index of the dataset in 'root' """
+    tmp_path = os.path.join(root, INDEX_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, os.path.join(root, INDEX_FILE))
+
+
+def read_index(root):
+    with open(os.path.join(root, INDEX_FILE)) as f:
+        return json.load(f)
+
+
+def truncate_npy(path, count):
+    """ Shrink the first axis of the .npy file at 'path' to 'count' rows in place """
+    array = np.load(path, mmap_mode='r')
+    shape = (count,) + array.shape[1:]
+    dtype, offset = array.dtype, array.offset
+    del array
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                  'fortran_order': False, 'shape': shape})
+    num_items = int(np.prod(shape))
+    if header.tell() != offset:  # the new header does not fit in place
+        np.save(path, np.fromfile(path, dtype, num_items, offset=offset).reshape(shape))
+        return
+    with open(path, 'r+b') as f:
+        f.write(header.getvalue())
+        f.truncate(offset + num_items * dtype.itemsize)
+
+
+class ShardWriter():
+    """ Stream samples into fixed-size shards under 'root'
+    Parameters:
+      root: directory of the dataset, created if needed
+      image_size: (H, W) of the images and templates
+      shard_size: number of samples per shard
+      resume: append to the dataset already in 'root', if any, instead of
+              starting a new one. Shards left incomplete by a killed writer
+              are discarded.
+      store_templates: write the templates.npy of the shards, False stores
+                       only the ground truth of the samples, which must have one
+      pyramid_levels: number of levels of the image and template pyramids,
+                      1 stores the full resolution only
+    The index is rewritten after every completed shard, so it always
+    describes a readable dataset, even if the writer is killed. """
+
+    def __init__(self, root, image_size, shard_size=1024, resume=False, store_templates=True,
+                 pyramid_levels=1):
+        self.root = root
+        self.image_size = tuple(image_size)
+        self.shard_size = shard_size
+        self.store_templates = store_templates
+        self.pyramid_levels = pyramid_levels
+        os.makedirs(root, exist_ok=True)
+        self.index = {'image_size': list(self.image_size), 'shard_size': shard_size,
+                      'pyramid_levels': pyramid_levels, 'num_samples': 0, 'kinds': [], 'shards': []}
+        if resume and os.path.exists(os.path.join(root, INDEX_FILE)):
+            self.index = read_index(root)
+            if tuple(self.index['image_size']) != self.image_size:
+                raise ValueError('Cannot resume the dataset in %s of image size %s with size %s'
+                                 % (root, tuple(self.index['image_size']), self.image_size))
+            if self.index.get('pyramid_levels', 1) != pyramid_levels:
+                raise ValueError('Cannot resume the dataset in %s of %d pyramid levels with %d'
+                                 % (root, self.index.get('pyramid_levels', 1), pyramid_levels))
+            # incomplete shards, and complete ones that were killed before being indexed
+            indexed = {shard['name'] for shard in self.index['shards']}
+            for name in os.listdir(root):
+                path = os.path.join(root, name)
+                if not os.path.isdir(path) or name in indexed:
+                    continue
+                if name.endswith('.tmp') or (name.startswith('shard-') and name[6:].isdigit()
+                                             and int(name[6:]) >= len(self.index['shards'])):
+                    shutil.rmtree(path)
+        self.count = 0
+        self.shard_dir = None
+
+    def next_index(self, default=0):
+        """ Return the sample index following the last sample of the completed
+        shards, where a resumed generation run restarts """
+        if not self.index['shards']:
+            return default
+        return self.index['shards'][-1]['last_index'] + 1
+
+    def _open_shard(self):
+        name = shard_name(len(self.index['shards']))
+        self.shard_dir = os.path.join(self.root, name + '.tmp')
+        if os.path.exists(self.shard_dir):
+            shutil.rmtree(self.shard_dir)
+        os.makedirs(self.shard_dir)
+        frames = (self.shard_size,) + self.image_size
+        open_memmap = np.lib.format.open_memmap
+        self.images = open_memmap(os.path.join(self.shard_dir, 'images.npy'), 'w+', np.uint8, frames)
+        if self.store_templates:
+            self.templates = open_memmap(os.path.join(self.shard_dir, 'templates.npy'), 'w+',
+                                         np.uint8, frames)
+        from generate_shape_2d import pyramid_size
+        for level in range(1, self.pyramid_levels):
+            level_frames = (self.shard_size,) + pyramid_size(self.image_size, level)
+            for field in self.level_fields(level):
+                setattr(self, field, open_memmap(os.path.join(self.shard_dir, field + '.npy'), 'w+',
+                                                 np.uint8, level_frames))
+        self.transforms = np.zeros((self.shard_size, 3, 3))
+        self.indices = np.zeros(self.shard_size, np.int64)
+        self.kinds = np.zeros(self.shard_size, np.uint8)
+        self.points, self.template_points = [], []
+        self.ground_truths = []
+        self.point_offsets = [0]
+        self.count = 0
+
+    def level_fields(self, level):
+        """ Names of the frame files of a pyramid level """
+        if level == 0:
+            return ['images', 'templates'] if self.store_templates else ['images']
+        if self.store_templates:
+            return ['images_%d' % level, 'templates_%d' % level]
+        return ['images_%d' % level]
+
+    def _write_pyramid(self, i, sample):
+        """ Write the levels 1, ... of the sample i, those of its pyramid if
+        it has one, and otherwise built from the full resolution frames """
+        import cv2
+        pyramid = sample.get('pyramid') or {}
+        images = pyramid.get('images')
+        templates = pyramid.get('templates')
+        for level in range(1, self.pyramid_levels):
+            image = getattr(self, 'images_%d' % level)[i]
+            if images is not None:
+                image[...] = images[level]
+            else:
+                cv2.pyrDown(sample['image'] if level == 1 else getattr(self, 'images_%d' % (level - 1))[i],
+                            dst=image)
+            if not self.store_templates:
+                continue
+            template = getattr(self, 'templates_%d' % level)[i]
+            if templates is not None:
+                template[...] = templates[level]
+            elif sample.get('ground_truth') is not None:
+                sample['ground_truth'].rasterize('template', template, level=level)
+            elif sample['template'] is not None:
+                cv2.pyrDown(sample['template'] if level == 1
+                            else getattr(self, 'templates_%d' % (level - 1))[i], dst=template)
+            else:
+                template[...] = 0
+
+    def write(self, sample):
+        """ Append a sample, as returned by generate_dataset.generate_sample """
+        if self.shard_dir is None:
+            self._open_shard()
+        if not self.store_templates and sample.get('ground_truth') is None:
+            raise ValueError('Cannot drop the template of sample %d, it has no ground truth'
+                             % sample['index'])
+        i = self.count
+        self.images[i] = sample['image']
+        if self.store_templates:
+            if sample['template'] is not None:
+                self.templates[i] = sample['template']
+            elif sample.get('ground_truth') is not None:
+                sample['ground_truth'].rasterize('template', self.templates[i])
+        if self.pyramid_levels > 1:
+            self._write_pyramid(i, sample)
+        self.transforms[i] = np.eye(3) if sample['M'] is None else sample['M']
+        self.indices[i] = sample['index']
+        if sample['kind'] not in self.index['kinds']:
+            self.index['kinds'].append(sample['kind'])
+        self.kinds[i] = self.index['kinds'].index(sample['kind'])
+        points = sample['points']
+        if points is None:
+            points = template_points = np.empty((0, 2), np.int32)
+        else:
+            template_points = sample['template_points']
+        self.points.append(np.asarray(points, np.int32).reshape(-1, 2))
+        self.template_points.append(np.asarray(template_points, np.int32).reshape(-1, 2))
+        self.point_offsets.append(self.point_offsets[-1] + len(self.points[-1]))
+        truth = sample.get('ground_truth')
+        self.ground_truths.append(None if truth is None else truth.to_dict())
+        self.count += 1
+        if self.count == self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """ Complete the current shard, even if it is not full, and index it """
+        if self.shard_dir is None:
+            return
+        count = self.count
+        frames = [field for level in range(self.pyramid_levels) for field in self.level_fields(level)]
+        for field in frames:
+            frame = self.__dict__.pop(field, None)  # released by a previous failed flush
+            if frame is not None:
+                frame.flush()
+                del frame
+            if count < self.shard_size:
+                truncate_npy(os.path.join(self.shard_dir, field + '.npy'), count)
+        np.save(os.path.join(self.shard_dir, 'transforms.npy'), self.transforms[:count])
+        np.save(os.path.join(self.shard_dir, 'indices.npy'), self.indices[:count])
+        np.save(os.path.join(self.shard_dir, 'kinds.npy'), self.kinds[:count])
+        np.save(os.path.join(self.shard_dir, 'points.npy'), np.concatenate(self.points))
+        np.save(os.path.join(self.shard_dir, 'template_points.npy'),
+                np.concatenate(self.template_points))
+        np.save(os.path.join(self.shard_dir, 'point_offsets.npy'),
+                np.array(self.point_offsets, np.int64))
+        if any(truth is not None for truth in self.ground_truths):
+            with open(os.path.join(self.shard_dir, 'ground_truth.json'), 'w') as f:
+                json.dump(self.ground_truths, f)
+        name = shard_name(len(self.index['shards']))
+        os.replace(self.shard_dir, os.path.join(self.root, name))
+        self.shard_dir = None
+        self.index['shards'].append({'name': name, 'count': count,
+                                     'first_index': int(self.indices[0]),
+                                     'last_index': int(self.indices[count - 1])})
+        self.index['num_samples'] += count
+        write_index(self.root, self.index)
+
+    def close(self):
+        self.flush()
+        write_index(self.root, self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # after an error the current shard is left incomplete, a resumed run discards it
+        if exc_type is None:
+            self.close()
+
+
+def write_samples(samples, root, image_size, shard_size=1024):
+    """ Write an iterable of samples, e.g. generate_dataset(), into a sharded
+    dataset and return its index """
+    with ShardWriter(root, image_size, shard_size) as writer:
+        for sample in samples:
+            writer.write(sample)
+    return writer.index
+
+
+def touch_pages(array, page_size=mmap.PAGESIZE):
+    """ Read one byte per page of a memory-mapped array to fault it in """
+    flat = array.reshape(-1).view(np.uint8)
+    return int(flat[::page_size].max()) if flat.size else 0
+
+
+def prefetch(iterable, depth=2, touch=None):
+    """ Iterate over 'iterable' in a background thread, keeping up to 'depth'
+    items ready ahead of the consumer. 'touch' is called on every item in the
+    thread, e.g. to fault in memory-mapped pages. """
+    items = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if touch is not None:
+                    touch(item)
+                while not stop.is_set():
+                    try:
+                        items.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            items.put(done)
+        except BaseException as e:
+            items.put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+class ShardReader():
+    """ Random access to a dataset written by ShardWriter. Images, templates,
+    transforms and keypoints are returned as views into the memory-mapped
+    shards, nothing is copied or decoded, except for the templates that were
+    not stored, which are rasterized from the ground truth.
+    Parameters:
+      root: directory of the dataset
+      template_cache_size: number of rasterized templates kept in an LRU cache
+    """
+
+    def __init__(self, root, template_cache_size=256):
+        self.root = root
+        self.index = read_index(root)
+        self.image_size = tuple(self.index['image_size'])
+        self.kinds = self.index['kinds']
+        self.pyramid_levels = self.index.get('pyramid_levels', 1)
+        fields = ['images', 'templates', 'transforms', 'points', 'template_points',
+                  'point_offsets', 'indices', 'kinds']
+        for level in range(1, self.pyramid_levels):
+            fields += ['images_%d' % level, 'templates_%d' % level]
+        self.shards = []
+        for shard in self.index['shards']:
+            shard_dir = os.path.join(root, shard['name'])
+            self.shards.append({field: np.load(os.path.join(shard_dir, field + '.npy'), mmap_mode='r')
+                                for field in fields
+                                if os.path.exists(os.path.join(shard_dir, field + '.npy'))})
+        self.ground_truths = {}
+        self.template_cache = OrderedDict()
+        self.template_cache_size = template_cache_size
+        self.lock = threading.Lock()
+        counts = [shard['count'] for shard in self.index['shards']]
+        self.starts = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def locate(self, i):
+        """ Return the (shard, position in the shard) of the sample i """
+        if not -len(self) <= i < len(self):
+            raise IndexError('sample %d out of range for %d samples' % (i, len(self)))
+        i = i % len(self)
+        shard_id = int(np.searchsorted(self.starts, i, side='right')) - 1
+        return shard_id, i - int(self.starts[shard_id])
+
+    def __getitem__(self, i):
+        shard_id, j = self.locate(i)
+        batch = self.read_batch(shard_id, j, j + 1)
+        offsets = batch['point_offsets']
+        return {'index': int(batch['indices'][0]), 'kind': self.kinds[batch['kinds'][0]],
+                'image': batch['images'][0], 'template': self.template(i),
+                'M': batch['M'][0], 'points': batch['points'][offsets[0]:offsets[1]],
+                'template_points': batch['template_points'][offsets[0]:offsets[1]]}
+
+    def ground_truth(self, i):
+        """ Return the ShapeGroundTruth of the sample i, None if it was not stored """
+        from generate_shape_2d import ShapeGroundTruth
+        shard_id, j = self.locate(i)
+        if shard_id not in self.ground_truths:
+            path = os.path.join(self.root, self.index['shards'][shard_id]['name'], 'ground_truth.json')
+            self.ground_truths[shard_id] = None
+            if os.path.exists(path):
+                with open(path) as f:
+                    self.ground_truths[shard_id] = json.load(f)
+        truths = self.ground_truths[shard_id]
+        if truths is None or truths[j] is None:
+            return None
+        return ShapeGroundTruth.from_dict(truths[j])
+
+    def template(self, i, level=0):
+        """ Return the template of the sample i at a pyramid level, a view of
+        the stored one or a read-only mask rasterized from its ground truth and cached """
+        from generate_shape_2d import pyramid_size
+        shard_id, j = self.locate(i)
+        shard = self.shards[shard_id]
+        field = 'templates_%d' % level if level else 'templates'
+        if field in shard:
+            return shard[field][j]
+        key = (int(self.starts[shard_id]) + j, level)
+        with self.lock:
+            if key in self.template_cache:
+                self.template_cache.move_to_end(key)
+                return self.template_cache[key]
+        if self.kinds[shard['kinds'][j]] == 'multiple_polygons':  # no template, black as when stored
+            template = np.zeros(pyramid_size(self.image_size, level), np.uint8)
+        else:
+            template = self.ground_truth(i).rasterize('template', level=level)
+        template.setflags(write=False)
+        with self.lock:
+            self.template_cache[key] = template
+            while len(self.template_cache) > self.template_cache_size:
+                self.template_cache.popitem(last=False)
+        return template
+
+    def level(self, i, level):
+        """ Return the sample i at a level of the pyramid, where the
+        coordinates are divided by 2 ** level. The transform is derived from
+        the stored one, S M S^-1 with S = diag(2^-level, 2^-level, 1), and the
+        keypoints are scaled to float coordinates. """
+        if not 0 <= level < self.pyramid_levels:
+            raise ValueError('%s has %d pyramid levels, got level %d'
+                             % (self.root, self.pyramid_levels, level))
+        if level == 0:
+            return self[i]
+        from generate_shape_2d import scale_transform
+        shard_id, j = self.locate(i)
+        shard = self.shards[shard_id]
+        first, last = shard['point_offsets'][j:j + 2]
+        scale = 0.5 ** level
+        return {'index': int(shard['indices'][j]), 'kind': self.kinds[shard['kinds'][j]],
+                'image': shard['images_%d' % level][j], 'template': self.template(i, level),
+                'M': scale_transform(shard['transforms'][j], level),
+                'points': shard['points'][first:last] * scale,
+                'template_points': shard['template_points'][first:last] * scale}
+
+    def read_batch(self, shard_id, start, stop):
+        """ Return the samples start, ..., stop - 1 of a shard as views:
+        'images' and 'templates' (N, H, W), 'M' (N, 3, 3), 'indices' and 'kinds' (N,),
+        'points' and 'template_points' (K, 2) with the keypoints of sample i in
+        points[point_offsets[i]:point_offsets[i + 1]] """
+        shard = self.shards[shard_id]
+        offsets = shard['point_offsets'][start:stop + 1]
+        first, last = int(offsets[0]), int(offsets[-1])
+        if 'templates' in shard:
+            templates = shard['templates'][start:stop]
+        else:
+            first_sample = int(self.starts[shard_id])
+            templates = np.stack([self.template(first_sample + j) for j in range(start, stop)])
+        return {'images': shard['images'][start:stop],
+                'templates': templates,
+                'M': shard['transforms'][start:stop],
+                'indices': shard['indices'][start:stop],
+                'kinds': shard['kinds'][start:stop],
+                'points': shard['points'][first:last],
+                'template_points': shard['template_points'][first:last],
+                'point_offsets': offsets - first}
+
+    def blocks(self, batch_size, shuffle=False, seed=None, drop_last=False):
+        """ Split every shard into contiguous blocks of batch_size samples and
+        return their (shard, start, stop), in a random order if 'shuffle' """
+        blocks = []
+        for shard_id, shard in enumerate(self.index['shards']):
+            for start in range(0, shard['count'], batch_size):
+                stop = min(start + batch_size, shard['count'])
+                if stop - start == batch_size or not drop_last:
+                    blocks.append((shard_id, start, stop))
+        if shuffle:
+            order = np.random.RandomState(seed).permutation(len(blocks))
+            blocks = [blocks[i] for i in order]
+        return blocks
+
+    def iter_batches(self, batch_size, shuffle=False, seed=None, drop_last=False, prefetch_depth=2):
+        """ Iterate over zero-copy batches, see read_batch().
+        Parameters:
+          batch_size: number of samples per batch, batches never span two shards
+                      so the last batch of each shard can be smaller
+          shuffle: visit the batches in a random order, the samples of a batch
+                   stay contiguous on disk
+          seed: seed of the shuffling, e.g. the epoch number
+          drop_last: skip the batches smaller than batch_size
+          prefetch_depth: number of batches whose pages are faulted in by a
+                          background thread, 0 to read in the calling thread
+        """
+        batches = (self.read_batch(*block)
+                   for block in self.blocks(batch_size, shuffle, seed, drop_last))
+        if prefetch_depth <= 0:
+            return batches
+        return prefetch(batches, prefetch_depth,
+                        lambda batch: (touch_pages(batch['images']), touch_pages(batch['templates'])))
+
+    def gather(self, indices, out=None):
+        """ Copy arbitrary samples into contiguous (N, H, W) images and templates
+        and (N, 3, 3) transforms, for fully shuffled batches. 'out' is a dict of
+        preallocated arrays returned by a previous call, to be reused. """
+        n = len(indices)
+        if out is None or len(out['images']) != n:
+            out = {'images': np.empty((n,) + self.image_size, np.uint8),
+                   'templates': np.empty((n,) + self.image_size, np.uint8),
+                   'M': np.empty((n, 3, 3))}
+        for k, i in enumerate(indices):
+            shard_id, j = self.locate(int(i))
+            shard = self.shards[shard_id]
+            out['images'][k] = shard['images'][j]
+            out['templates'][k] = self.template(int(i))
+            out['M'][k] = shard['transforms'][j]
+        return out
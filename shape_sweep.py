@@ -0,0 +1,247 @@
+""" Parameter sweeps of the synthetic shape generators
+
+Evaluates a set of parameter configurations of one generator, in parallel,
+one configuration per worker. Every configuration renders the same seeded
+samples and reports:
+  samples_per_s: throughput of the worker, template rasterization included
+  failure_rate: fraction of samples the generator gave up on
+  counters: rejection-loop and failure counters per sample (shape_profiling)
+  sampling: acceptance rates of the rejection samplers
+  shapes: mean and standard deviation over the successful samples of the
+          number of shapes, of their corners, of their area in pixels and of
+          the fraction of the image and of the template they cover
+The parameters are those of the generator, e.g. max_sides or rad, and of
+generate_background(), e.g. min_rad_ratio or max_kernel_size.
+
+Results are memoized in 'cache_dir' by (kind, parameters, seed, number of
+samples, size, code version), the code version being a hash of the sources
+the samples depend on, so running a sweep again only evaluates the new
+configurations, and editing a generator invalidates its results:
+
+    configurations = parameter_grid({'max_sides': [4, 8, 15], 'min_rad_ratio': [0.01, 0.02]})
+    results = run_sweep('polygon', configurations, cache_dir='.sweep_cache')
+    print(format_table(pareto_front(results)))
+"""
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from functools import lru_cache, partial
+
+import numpy as np
+
+import generate_dataset
+import generate_shape_2d as shapes
+import shape_profiling
+
+BACKGROUND_PARAMETERS = ('nb_blobs', 'min_rad_ratio', 'max_rad_ratio', 'min_kernel_size',
+                         'max_kernel_size')
+# sources the samples depend on, hashed into the cache keys
+SOURCES = ('generate_shape_2d.py', 'generate_dataset.py', 'shape_sweep.py')
+SHAPE_STATISTICS = ('shapes', 'corners', 'area_px', 'coverage', 'template_coverage')
+
+
+def parameter_grid(space):
+    """ Return the list of all the configurations of a {name: [values]} space """
+    names = sorted(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+
+
+def random_configurations(space, num_configurations, seed=0):
+    """ Draw configurations from a space of {name: [values]} choices and
+    {name: (low, high)} ranges, uniform in [low, high], integers if both bounds are """
+    state = np.random.RandomState(seed)
+    configurations = []
+    for _ in range(num_configurations):
+        configuration = {}
+        for name in sorted(space):
+            values = space[name]
+            if isinstance(values, tuple) and len(values) == 2:
+                low, high = values
+                if isinstance(low, int) and isinstance(high, int):
+                    configuration[name] = int(state.randint(low, high + 1))
+                else:
+                    configuration[name] = float(state.uniform(low, high))
+            else:
+                configuration[name] = values[state.randint(len(values))]
+        configurations.append(configuration)
+    return configurations
+
+
+@lru_cache(maxsize=1)
+def code_version():
+    """ Hash of the sources the samples and their statistics depend on """
+    root = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha1()
+    for name in SOURCES:
+        with open(os.path.join(root, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def cache_key(kind, params, num_samples, seed, size):
+    job = {'kind': kind, 'params': params, 'num_samples': num_samples, 'seed': seed,
+           'size': list(size), 'code_version': code_version()}
+    return hashlib.sha1(json.dumps(job, sort_keys=True).encode()).hexdigest()
+
+
+def shape_statistics(truth):
+    """ Return the number of shapes of a ShapeGroundTruth, their mean number
+    of corners and area in pixels, and the fraction of the image and of the
+    template they cover, None for the template of multiple_polygons """
+    if truth.kind == 'lines':
+        num_shapes, corners = len(truth.lines), 2
+    elif truth.kind == 'contours':
+        num_shapes, corners = 1, len(truth.control_points)
+    elif truth.kind == 'ellipses':
+        num_shapes, corners = len(truth.ellipses), 0
+    else:
+        num_shapes, corners = len(truth.polygons), np.mean([len(p) for p in truth.polygons])
+    covered = np.count_nonzero(truth.mask('image'))
+    template_coverage = None
+    if truth.kind != 'multiple_polygons':
+        template_coverage = np.count_nonzero(truth.mask('template')) / np.prod(truth.image_size)
+    return {'shapes': num_shapes, 'corners': float(corners), 'area_px': covered / max(num_shapes, 1),
+            'coverage': covered / np.prod(truth.image_size), 'template_coverage': template_coverage}
+
+
+def evaluate_configuration(kind, params, num_samples=200, seed=0, size=(480, 640)):
+    """ Render the samples 0, ..., num_samples - 1 of 'seed' with a
+    configuration and return their measures, see the module documentation
+    Parameters:
+      kind: name of the generator, one of generate_dataset.GENERATORS
+      params: parameters of the generator and of generate_background()
+    """
+    background_params = {name: value for name, value in params.items() if name in BACKGROUND_PARAMETERS}
+    generator_params = {name: value for name, value in params.items()
+                        if name not in BACKGROUND_PARAMETERS}
+    background = partial(shapes.generate_background, **background_params) if background_params else True
+    profiler = shape_profiling.profiler
+    was_enabled = profiler.enabled
+    profiler.reset()
+    shape_profiling.sampling_stats.reset()
+    shape_profiling.enable_profiling()
+    statistics = []
+    elapsed = 0.
+    try:
+        for index in range(num_samples):
+            start = time.perf_counter()
+            sample = generate_dataset.generate_sample(kind, index, seed, size, background,
+                                                      ground_truth=True, **generator_params)
+            if sample is not None and kind != 'multiple_polygons':
+                sample['ground_truth'].mask('template')  # the template is part of the sample cost
+            elapsed += time.perf_counter() - start
+            if sample is not None:
+                statistics.append(shape_statistics(sample['ground_truth']))
+        summary = profiler.summary()
+    finally:
+        shape_profiling.enable_profiling(was_enabled)
+    result = {'kind': kind, 'params': params, 'num_samples': num_samples, 'seed': seed,
+              'size': list(size), 'code_version': code_version(),
+              'samples_per_s': len(statistics) / max(elapsed, 1e-9),
+              'failure_rate': 1 - len(statistics) / num_samples,
+              'counters': {name: n / num_samples for name, n in summary['counts'].items()},
+              'sampling': {name: stats['acceptance_rate']
+                           for name, stats in summary['sampling'].items()},
+              'shapes': {}}
+    for name in SHAPE_STATISTICS:
+        values = [s[name] for s in statistics if s[name] is not None]
+        if values:
+            result['shapes'][name] = {'mean': float(np.mean(values)), 'std': float(np.std(values))}
+    return result
+
+
+def _evaluate(task, num_samples, seed, size, cache_dir):
+    kind, params = task
+    result = evaluate_configuration(kind, params, num_samples, seed, size)
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, cache_key(kind, params, num_samples, seed, size) + '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(result, f, indent=1)
+        os.replace(path + '.tmp', path)
+    return result
+
+
+def run_sweep(kind, configurations, num_samples=200, seed=0, size=(480, 640), num_workers=None,
+              cache_dir=None, refresh=False, log=None):
+    """ Evaluate configurations of a generator in parallel and return their
+    results in the same order, see evaluate_configuration()
+    Parameters:
+      kind: name of the generator, one of generate_dataset.GENERATORS
+      configurations: list of {parameter: value}, e.g. from parameter_grid()
+      num_samples: number of samples rendered per configuration
+      seed: seed of the samples, the same for all the configurations
+      size: size of the images
+      num_workers: number of processes, all the cores by default
+      cache_dir: directory the results are memoized in, None for no cache
+      refresh: evaluate the configurations again even if they are cached
+      log: function called with each result once it is available
+    """
+    generate_dataset.check_kinds(kind)
+    size = tuple(size)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    results = [None] * len(configurations)
+    missing = []
+    for k, params in enumerate(configurations):
+        path = None
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, cache_key(kind, params, num_samples, seed, size) + '.json')
+        if path is not None and not refresh and os.path.exists(path):
+            with open(path) as f:
+                results[k] = json.load(f)
+            if log is not None:
+                log(results[k])
+        else:
+            missing.append(k)
+    if not missing:
+        return results
+
+    evaluate = partial(_evaluate, num_samples=num_samples, seed=seed, size=size, cache_dir=cache_dir)
+    tasks = [(kind, configurations[k]) for k in missing]
+    num_workers = min(num_workers or multiprocessing.cpu_count(), len(tasks))
+    if num_workers == 1:
+        evaluated = map(evaluate, tasks)
+    else:
+        pool = multiprocessing.Pool(num_workers, initializer=generate_dataset.ignore_interrupts)
+        evaluated = pool.imap(evaluate, tasks)
+    try:
+        for k, result in zip(missing, evaluated):
+            results[k] = result
+            if log is not None:
+                log(result)
+    finally:
+        if num_workers > 1:
+            pool.terminate()
+    return results
+
+
+def pareto_front(results, maximize=('samples_per_s',), minimize=('failure_rate',)):
+    """ Return the results no other result is at least as good as on every
+    objective and strictly better on one, sorted by decreasing first objective """
+    def objectives(result):
+        return np.array([result[name] for name in maximize] + [-result[name] for name in minimize])
+
+    scores = [objectives(result) for result in results]
+    front = [result for result, score in zip(results, scores)
+             if not any(np.all(other >= score) and np.any(other > score) for other in scores)]
+    return sorted(front, key=lambda result: -objectives(result)[0])
+
+
+def format_table(results):
+    """ Return the results as a plain text table, one configuration per line """
+    lines = ['%12s %8s %8s %8s %10s %9s %9s   %s'
+             % ('samples/s', 'failed', 'shapes', 'corners', 'area px', 'coverage', 'template',
+                'parameters')]
+    for result in results:
+        stats = {name: result['shapes'].get(name, {}).get('mean', float('nan'))
+                 for name in SHAPE_STATISTICS}
+        params = ' '.join('%s=%s' % (name, '%.4g' % value if isinstance(value, float) else value)
+                          for name, value in sorted(result['params'].items()))
+        lines.append('%12.1f %8.3f %8.1f %8.1f %10.0f %9.3f %9.3f   %s'
+                     % (result['samples_per_s'], result['failure_rate'], stats['shapes'],
+                        stats['corners'], stats['area_px'], stats['coverage'],
+                        stats['template_coverage'], params or '-'))
+    return '\n'.join(lines)
@@ -0,0 +1,98 @@
+""" Resumption and determinism of the sharded dataset generation """
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import generate_dataset  # noqa: E402
+import shape_shards  # noqa: E402
+from shape_shards import ShardReader  # noqa: E402
+
+JOB = dict(kind='polygon', num_samples=20, base_seed=3, size=(60, 80), shard_size=6, round_size=8,
+           background=False)
+
+
+class Killed(BaseException):
+    pass
+
+
+def assert_same_dataset(root_a, root_b):
+    a, b = ShardReader(root_a), ShardReader(root_b)
+    assert len(a) == len(b)
+    for i in range(len(a)):
+        sample_a, sample_b = a[i], b[i]
+        assert sample_a['index'] == sample_b['index']
+        for field in ('image', 'template', 'M', 'points', 'template_points'):
+            np.testing.assert_array_equal(sample_a[field], sample_b[field])
+
+
+@pytest.fixture(scope='module')
+def reference(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp('reference'))
+    generate_dataset.generate_shards(root, num_workers=1, **JOB)
+    return root
+
+
+def test_same_dataset_with_more_workers(reference, tmp_path):
+    generate_dataset.generate_shards(str(tmp_path), num_workers=2, **JOB)
+    assert_same_dataset(reference, str(tmp_path))
+
+
+@pytest.mark.parametrize('killed_at', ['write', 'index'])
+def test_resume_after_kill(reference, tmp_path, monkeypatch, killed_at):
+    """ Kill the writer in the middle of the second shard, or after the second
+    shard was moved in place but before it was indexed, then resume """
+    root = str(tmp_path)
+    write_index = shape_shards.write_index
+    written = []
+
+    def killing_write_index(root, index):
+        if killed_at == 'index' and len(index['shards']) == 2:
+            raise Killed()
+        write_index(root, index)
+
+    def killing_write(self, sample, write=shape_shards.ShardWriter.write):
+        written.append(sample['index'])
+        if killed_at == 'write' and len(written) == 9:
+            raise Killed()
+        write(self, sample)
+
+    monkeypatch.setattr(shape_shards, 'write_index', killing_write_index)
+    monkeypatch.setattr(shape_shards.ShardWriter, 'write', killing_write)
+    with pytest.raises(Killed):
+        generate_dataset.generate_shards(root, num_workers=1, **JOB)
+    monkeypatch.undo()
+    assert len(shape_shards.read_index(root)['shards']) == 1
+
+    index = generate_dataset.generate_shards(root, num_workers=1, **JOB)
+    assert index['num_samples'] == JOB['num_samples']
+    assert sorted(name for name in os.listdir(root) if name.startswith('shard-')) == \
+        [shard['name'] for shard in index['shards']]
+    assert_same_dataset(reference, root)
+
+
+@pytest.mark.parametrize('kind', ['polygon', 'multiple_polygons'])
+def test_stored_templates_match_ground_truth(tmp_path, kind):
+    """ Templates stored at write time and rasterized at read time agree,
+    black for multiple_polygons, at every pyramid level """
+    samples = [generate_dataset.generate_sample(kind, i, 3, (60, 80), background=False,
+                                                ground_truth=True)
+               for i in range(6)]
+    samples = [sample for sample in samples if sample is not None]
+    readers = []
+    for store_templates in (True, False):
+        root = str(tmp_path / str(store_templates))
+        with shape_shards.ShardWriter(root, (60, 80), shard_size=4, store_templates=store_templates,
+                                      pyramid_levels=2) as writer:
+            for sample in samples:
+                writer.write(sample)
+        readers.append(ShardReader(root))
+    stored, rasterized = readers
+    for i in range(len(samples)):
+        for level in range(2):
+            np.testing.assert_array_equal(stored.level(i, level)['template'],
+                                          rasterized.level(i, level)['template'])
+            if kind == 'multiple_polygons':
+                assert stored.level(i, level)['template'].max() == 0